@@ -1,21 +1,41 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, has_request_context, send_file, Response
 from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user, current_user
-import json
+import orjson
 import os
 from datetime import datetime, timedelta, date
 import uuid
+import calendar
+from bisect import insort
 import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import shutil
+import gzip
+import heapq
+import itertools
 import telebot
+from telebot import types
 from config import TELEGRAM_BOT_TOKEN, ADMIN_TELEGRAM_ID, SECRET_KEY
+from bot import (
+    bot as telegram_bot, get_user_safe_name, check_user_documents,
+    notify_user_about_approval, notify_user_about_rejection, notify_user_about_rental_end
+)
 
 # Импорт модулей оптимизации производительности
 from performance_optimizer import (
     get_db_manager, get_file_handler, get_data_processor, get_memory_optimizer,
-    memory_optimized, get_system_performance
+    memory_optimized, get_system_performance, write_bytes_atomic, freeze_startup_objects
 )
 from async_bot_handler import async_bot_handler, initialize_async_bot_handler
 
+# ijson позволяет отфильтровать большой файл, не загружая его целиком
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
 
@@ -39,67 +59,329 @@ BLOCKED_DATES_FILE = os.path.join(DATA_DIR, 'blocked_dates.json')
 CALENDAR_FILE = os.path.join(DATA_DIR, 'calendar.json')
 RATINGS_FILE = os.path.join(DATA_DIR, 'ratings.json')
 
+# Постоянный фоновый цикл событий для асинхронных операций с файлами
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+def get_async_loop():
+    """Получить фоновый цикл событий, запуская его при первом обращении"""
+    global _async_loop
+    if _async_loop is None:
+        with _async_loop_lock:
+            if _async_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='async-io-loop', daemon=True).start()
+                _async_loop = loop
+    return _async_loop
+
+def run_async(coro):
+    """Выполнить корутину в фоновом цикле событий и дождаться результата"""
+    return asyncio.run_coroutine_threadsafe(coro, get_async_loop()).result()
+
+# orjson сериализует сразу в UTF-8 байты одним буфером
+ORJSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+def _write_json_direct(filename, data):
+    """Атомарная запись JSON напрямую в файл (резервный путь)"""
+    payload = orjson.dumps(data, default=str, option=ORJSON_OPTIONS)
+    # Один вызов write для всего буфера, fsync до и после подмены файла
+    write_bytes_atomic(filename, payload)
+
+def orjson_response(payload):
+    """JSON ответ, сериализованный orjson (быстрее jsonify на больших списках)"""
+    return Response(orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS, default=str), mimetype='application/json')
+
+def _request_json_cache():
+    """Кеш JSON файлов на время текущего HTTP запроса (None вне запроса)"""
+    if not has_request_context():
+        return None
+    if 'json_cache' not in g:
+        g.json_cache = {}
+    return g.json_cache
+
 @memory_optimized
 def load_json_file(filename):
     """Оптимизированная загрузка JSON файлов с кешированием"""
+    # Повторное чтение того же файла в рамках одного запроса берем из памяти
+    request_cache = _request_json_cache()
+    if request_cache is not None and filename in request_cache:
+        return request_cache[filename]
+    
     try:
-        # Используем высокопроизводительный обработчик файлов
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_db_manager().load_data(os.path.basename(filename)))
-        loop.close()
-        return result
+        # Чтение синхронное: цикл событий для одного файла только добавляет накладные расходы
+        data = get_db_manager().load_data_sync(os.path.basename(filename))
     except Exception as e:
         print(f"Ошибка загрузки {filename}: {e}")
         # Fallback на старый метод
+        data = {}
         if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
+            with open(filename, 'rb') as f:
+                data = orjson.loads(f.read())
+    
+    if request_cache is not None:
+        request_cache[filename] = data
+    return data
+
+async def _load_many(names):
+    """Параллельная загрузка нескольких файлов через менеджер БД"""
+    db = get_db_manager()
+    return await asyncio.gather(*(db.load_data(name) for name in names))
+
+def load_json_files(*filenames):
+    """Загрузка нескольких JSON файлов одновременно (чтения с диска перекрываются)"""
+    request_cache = _request_json_cache()
+    missing = [f for f in filenames if request_cache is None or f not in request_cache]
+    
+    if missing:
+        try:
+            loaded = run_async(_load_many([os.path.basename(f) for f in missing]))
+        except Exception as e:
+            print(f"Ошибка параллельной загрузки файлов: {e}")
+            loaded = [load_json_file(f) for f in missing]
+        
+        if request_cache is None:
+            results = dict(zip(missing, loaded))
+            return [results[f] for f in filenames]
+        request_cache.update(zip(missing, loaded))
+    
+    return [request_cache[f] for f in filenames]
 
 @memory_optimized
 def save_json_file(filename, data):
     """Оптимизированное сохранение JSON файлов с асинхронностью"""
+    request_cache = _request_json_cache()
+    if request_cache is not None:
+        request_cache[filename] = data
+        
+        # Внутри batched_writes() запись откладывается до выхода из блока
+        pending_writes = g.get('pending_writes')
+        if pending_writes is not None:
+            pending_writes[filename] = data
+            return True
+    
+    return _write_json_file(filename, data)
+
+@contextmanager
+def batched_writes():
+    """Отложить save_json_file до конца блока: каждый файл записывается один раз.
+    
+    Записи выполняются только при нормальном выходе из блока; при исключении вся пачка
+    отбрасывается, чтобы не сохранить половину связанного изменения (например, заявку
+    одобренной без созданной аренды).
+    """
+    if g.get('pending_writes') is not None:
+        # Вложенный блок - запись выполнит внешний
+        yield
+        return
+    
+    g.pending_writes = {}
+    try:
+        yield
+    except BaseException:
+        # Измененные, но не записанные данные убираем и из кеша запроса
+        request_cache = _request_json_cache()
+        for filename in g.pop('pending_writes'):
+            request_cache.pop(filename, None)
+        raise
+    
+    for filename, data in g.pop('pending_writes').items():
+        _write_json_file(filename, data)
+
+def _write_json_file(filename, data):
+    """Немедленная запись JSON файла через менеджер БД"""
     try:
         # Используем высокопроизводительный обработчик файлов
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        success = loop.run_until_complete(get_db_manager().save_data(os.path.basename(filename), data))
-        loop.close()
+        success = run_async(get_db_manager().save_data(os.path.basename(filename), data))
         
         if not success:
             # Fallback на старый метод при ошибке
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            _write_json_direct(filename, data)
                 
     except Exception as e:
         print(f"Ошибка сохранения {filename}: {e}")
         # Fallback на старый метод
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        _write_json_direct(filename, data)
+    
+    return True
+
+def find_record_ids(filename, field, value):
+    """Ключи записей JSON файла с заданным значением поля (по индексу менеджера БД)"""
+    return get_db_manager().get_index(os.path.basename(filename), field).get(value, set())
+
+def _group_reservations_by_console(calendar_data):
+    """Резервации календаря в виде {console_id: {дата: список резерваций}}"""
+    grouped = {}
+    for date_key, res_list in calendar_data.get('reservations', {}).items():
+        # Ключ резервации имеет вид "<дата>_<console_id>"
+        date_part, _, console_id = date_key.partition('_')
+        grouped.setdefault(console_id, {})[date_part] = res_list
+    return grouped
+
+def _build_taken_slots(calendar_data):
+    """Занятые временные слоты в виде {"<дата>_<console_id>": set(слотов)}"""
+    return {
+        date_key: {r['time_slot'] for r in res_list}
+        for date_key, res_list in calendar_data.get('reservations', {}).items()
+    }
+
+def get_taken_slots(date_key):
+    """Занятые слоты на ключ резервации (индекс в памяти, в calendar.json не сохраняется)"""
+    taken = get_db_manager().get_derived(
+        os.path.basename(CALENDAR_FILE), 'taken_slots', _build_taken_slots
+    )
+    return taken.get(date_key, frozenset())
+
+def _build_reservation_keys(calendar_data):
+    """Обратный индекс {id резервации: "<дата>_<console_id>"}"""
+    return {
+        r['id']: date_key
+        for date_key, res_list in calendar_data.get('reservations', {}).items()
+        for r in res_list
+    }
+
+def _build_holidays_by_date(calendar_data):
+    """Праздники календаря в виде {дата: праздник}"""
+    return {h['date']: h for h in calendar_data.get('holidays', [])}
+
+def get_holidays_by_date():
+    """Праздники по датам; в calendar.json остаются списком, индекс строится только в памяти"""
+    return get_db_manager().get_derived(
+        os.path.basename(CALENDAR_FILE), 'holidays_by_date', _build_holidays_by_date
+    )
+
+def _build_console_names(consoles):
+    """Названия консолей в виде {console_id: название}"""
+    return {console_id: console.get('name', 'Неизвестная консоль') for console_id, console in consoles.items()}
+
+def get_console_name(console_id):
+    """Название консоли (индекс пересчитывается только при изменении consoles.json)"""
+    names = get_db_manager().get_derived(
+        os.path.basename(CONSOLES_FILE), 'console_names', _build_console_names
+    )
+    return names.get(console_id, 'Неизвестная консоль')
+
+def get_console_reservations(console_id):
+    """Резервации консоли по датам (группировка пересчитывается только при изменении calendar.json)"""
+    grouped = get_db_manager().get_derived(
+        os.path.basename(CALENDAR_FILE), 'reservations_by_console', _group_reservations_by_console
+    )
+    return grouped.get(console_id, {})
+
+def load_blocked_dates():
+    """Заблокированные даты из кеша менеджера БД (файл перечитывается только при изменении)"""
+    blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+    blocked_dates.setdefault('system_blocked_dates', [])
+    blocked_dates.setdefault('console_blocked_dates', {})
+    return blocked_dates
+
+def load_active_rentals(file_path):
+    """Только активные аренды из файла; при наличии ijson файл разбирается потоком"""
+    with open(file_path, 'rb') as f:
+        if ijson is None:
+            rentals = orjson.loads(f.read() or b'{}')
+            return {k: v for k, v in rentals.items() if v.get('status') == 'active'}
+        return {k: v for k, v in ijson.kvitems(f, '', use_float=True) if v.get('status') == 'active'}
+
+# Неизменяемые части ответа предпросмотра календаря
+MONTH_NAMES = list(calendar.month_name)
+CALENDAR_PREVIEW_LEGEND = {
+    'available': 'Доступно',
+    'occupied': 'Занято (активная аренда)',
+    'reserved': 'Забронировано',
+    'system_blocked': 'Заблокировано (система)',
+    'console_blocked': 'Заблокировано (консоль)',
+    'non_working_day': 'Нерабочий день',
+    'holiday': 'Праздничный день',
+    'past_date': 'Прошедшая дата'
+}
+
+CONSOLE_IMAGES_DIR = os.path.join('static', 'img', 'console')
+CONSOLE_PHOTO_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'webp']  # В порядке приоритета
+CONSOLE_PHOTO_ALLOWED_EXTENSIONS = frozenset(CONSOLE_PHOTO_EXTENSIONS)
+CONSOLE_PHOTO_MAX_SIZE = 10 * 1024 * 1024  # 10 MB
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# Кеш содержимого папки с фото: (st_mtime_ns папки, {console_id: путь к фото})
+_console_photos_cache = (None, {})
+
+def scan_console_photos():
+    """Получить пути к фото всех консолей; папка перечитывается только после ее изменения"""
+    global _console_photos_cache
+    try:
+        dir_mtime = os.stat(CONSOLE_IMAGES_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    
+    cached_mtime, photos = _console_photos_cache
+    if cached_mtime == dir_mtime:
+        return photos
+    
+    found = {}
+    for name in os.listdir(CONSOLE_IMAGES_DIR):
+        console_id, _, ext = name.rpartition('.')
+        if console_id and ext in CONSOLE_PHOTO_EXTENSIONS:
+            found.setdefault(console_id, []).append(ext)
+    
+    photos = {
+        console_id: f"/static/img/console/{console_id}.{min(exts, key=CONSOLE_PHOTO_EXTENSIONS.index)}"
+        for console_id, exts in found.items()
+    }
+    _console_photos_cache = (dir_mtime, photos)
+    return photos
+
+def find_console_photo_files(console_id):
+    """Все файлы фото консоли на диске (одно чтение папки)"""
+    try:
+        with os.scandir(CONSOLE_IMAGES_DIR) as entries:
+            return [
+                entry.path for entry in entries
+                if entry.name.rpartition('.')[0] == console_id
+                and entry.name.rpartition('.')[2] in CONSOLE_PHOTO_ALLOWED_EXTENSIONS
+                and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
 
 def get_console_photo_path(console_id):
     """Получить путь к фото консоли если существует"""
-    console_images_dir = os.path.join('static', 'img', 'console')
-    allowed_extensions = ['png', 'jpg', 'jpeg', 'gif', 'webp']
-    
-    for ext in allowed_extensions:
-        file_path = os.path.join(console_images_dir, f"{console_id}.{ext}")
-        if os.path.exists(file_path):
-            return f"/static/img/console/{console_id}.{ext}"
-    return None
+    return scan_console_photos().get(console_id)
 
 class User(UserMixin):
     def __init__(self, user_id):
         self.id = user_id
 
+# Логины администраторов; перечитываются только при изменении файла
+_ADMIN_SET = frozenset()
+_ADMIN_MTIME = None
+_admin_set_lock = threading.Lock()
+
+def _admin_usernames():
+    """Множество логинов администраторов (одна проверка mtime на запрос)"""
+    global _ADMIN_SET, _ADMIN_MTIME
+    try:
+        mtime = os.stat(ADMINS_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    
+    if mtime != _ADMIN_MTIME:
+        with _admin_set_lock:
+            if mtime != _ADMIN_MTIME:
+                _ADMIN_SET = frozenset(load_json_file(ADMINS_FILE).keys())
+                _ADMIN_MTIME = mtime
+    return _ADMIN_SET
+
 @login_manager.user_loader
 def load_user(user_id):
-    admins = load_json_file(ADMINS_FILE)
-    if user_id in admins:
+    if user_id in _admin_usernames():
         return User(user_id)
     return None
 
+@app.before_request
+def _stamp_request_time():
+    """Единое время запроса: одно обращение к часам и одно форматирование на запрос"""
+    g.now = datetime.now()
+    g.now_iso = g.now.isoformat()
+
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 
 @app.route('/')
@@ -129,20 +411,17 @@ def logout():
 @app.route('/admin')
 @login_required
 def admin():
-    consoles = load_json_file(CONSOLES_FILE)
-    users = load_json_file(USERS_FILE)
-    rentals = load_json_file(RENTALS_FILE)
-    rental_requests = load_json_file(RENTAL_REQUESTS_FILE)
-    admin_settings = load_json_file(ADMIN_SETTINGS_FILE)
+    consoles, users, rentals, rental_requests, admin_settings, discounts = load_json_files(
+        CONSOLES_FILE, USERS_FILE, RENTALS_FILE, RENTAL_REQUESTS_FILE, ADMIN_SETTINGS_FILE, DISCOUNTS_FILE
+    )
     
-    # Добавляем пути к фото для каждой консоли
+    # Добавляем пути к фото для каждой консоли (одно чтение папки на все консоли)
+    console_photos = scan_console_photos()
     for console_id, console in consoles.items():
-        photo_path = get_console_photo_path(console_id)
+        photo_path = console_photos.get(console_id)
         if photo_path:
             console['photo_path'] = photo_path
     
-    discounts = load_json_file(DISCOUNTS_FILE)
-    
     return render_template('admin.html', 
                          consoles=consoles, 
                          users=users, 
@@ -168,7 +447,7 @@ def manage_consoles():
             'sale_price': data.get('sale_price', 0),
             'show_photo_in_bot': data.get('show_photo_in_bot', True),
             'status': 'available',
-            'created_at': datetime.now().isoformat()
+            'created_at': g.now_iso
         }
         save_json_file(CONSOLES_FILE, consoles)
         return jsonify({'status': 'success', 'console': consoles[console_id]})
@@ -191,7 +470,7 @@ def manage_consoles():
         console['rental_price'] = data.get('rental_price', console['rental_price'])
         console['sale_price'] = data.get('sale_price', console.get('sale_price', 0))
         console['show_photo_in_bot'] = data.get('show_photo_in_bot', console.get('show_photo_in_bot', True))
-        console['updated_at'] = datetime.now().isoformat()
+        console['updated_at'] = g.now_iso
         
         # Обновляем путь к фото если передан
         if 'photo_path' in data:
@@ -202,10 +481,11 @@ def manage_consoles():
     
     elif request.method == 'DELETE':
         console_id = request.json.get('console_id')
-        if console_id in consoles:
-            del consoles[console_id]
-            save_json_file(CONSOLES_FILE, consoles)
-            return jsonify({'status': 'success'})
+        if consoles.pop(console_id, None) is None:
+            return jsonify({'status': 'error', 'message': 'Консоль не найдена'}), 404
+        
+        save_json_file(CONSOLES_FILE, consoles)
+        return jsonify({'status': 'success'})
     
     return jsonify(consoles)
 
@@ -239,33 +519,34 @@ def manage_users():
         try:
             # Сохраняем данные пользователя до удаления для удаления документов
             deleted_user = users[user_id]
-            user_full_name = deleted_user.get('full_name', deleted_user.get('first_name', f'user_{user_id}'))
+            safe_name = get_user_safe_name(deleted_user, user_id)
             
-            # Удаляем пользователя из базы
-            del users[user_id]
-            save_json_file(USERS_FILE, users)
+            with batched_writes():
+                # Удаляем пользователя из базы
+                del users[user_id]
+                save_json_file(USERS_FILE, users)
             
-            # Удаляем связанные данные пользователя
-            rentals = load_json_file(RENTALS_FILE)
-            rental_requests = load_json_file(RENTAL_REQUESTS_FILE)
+                # Удаляем связанные данные пользователя
+                rentals = load_json_file(RENTALS_FILE)
+                rental_requests = load_json_file(RENTAL_REQUESTS_FILE)
             
-            # Удаляем аренды пользователя
-            rentals_to_delete = [rental_id for rental_id, rental in rentals.items() if rental.get('user_id') == user_id]
-            for rental_id in rentals_to_delete:
-                del rentals[rental_id]
+                # Удаляем аренды пользователя
+                rentals_to_delete = [rental_id for rental_id in find_record_ids(RENTALS_FILE, 'user_id', user_id)
+                                     if rental_id in rentals]
+                for rental_id in rentals_to_delete:
+                    del rentals[rental_id]
             
-            # Удаляем заявки пользователя
-            requests_to_delete = [req_id for req_id, req in rental_requests.items() if req.get('user_id') == user_id]
-            for req_id in requests_to_delete:
-                del rental_requests[req_id]
+                # Удаляем заявки пользователя
+                requests_to_delete = [req_id for req_id in find_record_ids(RENTAL_REQUESTS_FILE, 'user_id', user_id)
+                                      if req_id in rental_requests]
+                for req_id in requests_to_delete:
+                    del rental_requests[req_id]
             
-            # Сохраняем обновленные данные
-            save_json_file(RENTALS_FILE, rentals)
-            save_json_file(RENTAL_REQUESTS_FILE, rental_requests)
+                # Сохраняем обновленные данные
+                save_json_file(RENTALS_FILE, rentals)
+                save_json_file(RENTAL_REQUESTS_FILE, rental_requests)
             
             # Пытаемся удалить папку с документами пользователя
-            import shutil
-            safe_name = "".join(c for c in user_full_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
             user_docs_folder = os.path.join(PASSPORT_DIR, safe_name)
             if os.path.exists(user_docs_folder):
                 shutil.rmtree(user_docs_folder)
@@ -306,7 +587,7 @@ def manage_rentals():
         if rental['status'] == 'active':
             # Рассчитываем стоимость
             start_time = datetime.fromisoformat(rental['start_time'])
-            end_time = datetime.now()
+            end_time = g.now
             duration = end_time - start_time
             hours = max(1, int(duration.total_seconds() / 3600))
             
@@ -326,14 +607,14 @@ def manage_rentals():
             if user_id in users:
                 users[user_id]['total_spent'] = users[user_id].get('total_spent', 0) + total_cost
             
-            # Сохраняем изменения
-            save_json_file(RENTALS_FILE, rentals)
-            save_json_file(CONSOLES_FILE, consoles)
-            save_json_file(USERS_FILE, users)
+            # Сохраняем изменения одной пачкой
+            with batched_writes():
+                save_json_file(RENTALS_FILE, rentals)
+                save_json_file(CONSOLES_FILE, consoles)
+                save_json_file(USERS_FILE, users)
             
             # Отправляем уведомление пользователю о завершении аренды
             try:
-                from bot import bot, notify_user_about_rental_end
                 notify_user_about_rental_end(user_id, rental['console_id'], total_cost, hours)
             except Exception as e:
                 print(f"Ошибка отправки уведомления пользователю о завершении аренды: {e}")
@@ -392,45 +673,45 @@ def manage_rental_requests():
                 console_id = request_data['console_id']
                 
                 if console_id in consoles and consoles[console_id]['status'] == 'available':
-                    # Одобряем заявку и создаем аренду
-                    request_data['status'] = 'approved'
-                    save_json_file(RENTAL_REQUESTS_FILE, rental_requests)
+                    # Одобряем заявку и создаем аренду; все файлы записываются одной пачкой
+                    with batched_writes():
+                        request_data['status'] = 'approved'
+                        save_json_file(RENTAL_REQUESTS_FILE, rental_requests)
                     
-                    # Создаем аренду (логика из бота)
-                    rentals = load_json_file(RENTALS_FILE)
-                    users = load_json_file(USERS_FILE)
+                        # Создаем аренду (логика из бота)
+                        rentals = load_json_file(RENTALS_FILE)
+                        users = load_json_file(USERS_FILE)
                     
-                    rental_id = str(uuid.uuid4())
-                    # Получаем данные о выбранном времени из заявки
-                    selected_hours = request_data.get('selected_hours')
-                    expected_cost = request_data.get('expected_cost', 0)
-                    end_time = None
+                        rental_id = str(uuid.uuid4())
+                        # Получаем данные о выбранном времени из заявки
+                        selected_hours = request_data.get('selected_hours')
+                        expected_cost = request_data.get('expected_cost', 0)
+                        end_time = None
                     
-                    if selected_hours:
-                        end_time = (datetime.now() + timedelta(hours=selected_hours)).isoformat()
+                        if selected_hours:
+                            end_time = (g.now + timedelta(hours=selected_hours)).isoformat()
                     
-                    rental = {
-                        'id': rental_id,
-                        'user_id': request_data['user_id'],
-                        'console_id': console_id,
-                        'start_time': datetime.now().isoformat(),
-                        'expected_end_time': end_time,
-                        'selected_hours': selected_hours,
-                        'expected_cost': expected_cost,
-                        'end_time': None,
-                        'status': 'active',
-                        'total_cost': 0
-                    }
+                        rental = {
+                            'id': rental_id,
+                            'user_id': request_data['user_id'],
+                            'console_id': console_id,
+                            'start_time': g.now_iso,
+                            'expected_end_time': end_time,
+                            'selected_hours': selected_hours,
+                            'expected_cost': expected_cost,
+                            'end_time': None,
+                            'status': 'active',
+                            'total_cost': 0
+                        }
                     
-                    rentals[rental_id] = rental
-                    consoles[console_id]['status'] = 'rented'
+                        rentals[rental_id] = rental
+                        consoles[console_id]['status'] = 'rented'
                     
-                    save_json_file(RENTALS_FILE, rentals)
-                    save_json_file(CONSOLES_FILE, consoles)
+                        save_json_file(RENTALS_FILE, rentals)
+                        save_json_file(CONSOLES_FILE, consoles)
                     
                     # Отправляем уведомление пользователю в Telegram
                     try:
-                        from bot import bot, notify_user_about_approval
                         notify_user_about_approval(request_data['user_id'], console_id, rental_id)
                     except Exception as e:
                         print(f"Ошибка отправки уведомления пользователю: {e}")
@@ -446,7 +727,6 @@ def manage_rental_requests():
             
             # Отправляем уведомление пользователю о отклонении
             try:
-                from bot import bot, notify_user_about_rejection
                 notify_user_about_rejection(request_data['user_id'], request_data['console_id'])
             except Exception as e:
                 print(f"Ошибка отправки уведомления пользователю: {e}")
@@ -470,10 +750,6 @@ def request_user_location():
         if user_id not in users:
             return jsonify({'status': 'error', 'message': 'Пользователь не найден'})
         
-        # Импортируем бот и отправляем запрос геолокации
-        from bot import bot
-        from telebot import types
-        
         user = users[user_id]
         
         # Создаем кнопку для отправки геолокации
@@ -485,7 +761,7 @@ def request_user_location():
         user_message += f"Администратор запросил вашу текущую геолокацию через веб-панель.\n"
         user_message += f"Нажмите кнопку ниже, чтобы отправить ее."
         
-        bot.send_message(user_id, user_message, parse_mode='Markdown', reply_markup=location_markup)
+        telegram_bot.send_message(user_id, user_message, parse_mode='Markdown', reply_markup=location_markup)
         
         return jsonify({
             'status': 'success',
@@ -508,12 +784,7 @@ def get_user_documents(user_id):
         user = users[user_id]
         user_full_name = user.get('full_name', user.get('first_name', f'user_{user_id}'))
         
-        # Импортируем функцию из бота
-        import sys
-        sys.path.append('.')
-        from bot import check_user_documents
-        
-        documents = check_user_documents(user_full_name, user_id)
+        documents = check_user_documents(user_full_name, user_id, get_user_safe_name(user, user_id))
         
         return jsonify({
             'status': 'success',
@@ -535,8 +806,7 @@ def view_document(user_id, document_type):
             return jsonify({'status': 'error', 'message': 'Пользователь не найден'})
         
         user = users[user_id]
-        user_full_name = user.get('full_name', user.get('first_name', f'user_{user_id}'))
-        safe_name = "".join(c for c in user_full_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        safe_name = get_user_safe_name(user, user_id)
         
         # Проверяем допустимые типы документов
         if document_type not in ['passport_front', 'passport_back', 'selfie_with_passport']:
@@ -549,20 +819,25 @@ def view_document(user_id, document_type):
         if not os.path.exists(user_folder):
             return jsonify({'status': 'error', 'message': 'Папка пользователя не найдена'})
         
-        # Ищем файл с разными расширениями
+        # Ищем файл с разными расширениями за один проход по папке
+        document_files = {}
+        with os.scandir(user_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and '.' in entry.name:
+                    name, ext = entry.name.rsplit('.', 1)
+                    if name == document_type:
+                        document_files[ext] = entry.path
+        
         document_path = None
         for ext in ['jpg', 'jpeg', 'png', 'webp']:
-            filename = f"{document_type}.{ext}"
-            filepath = os.path.join(user_folder, filename)
-            if os.path.exists(filepath):
-                document_path = filepath
+            if ext in document_files:
+                document_path = document_files[ext]
                 break
         
         if not document_path:
             return jsonify({'status': 'error', 'message': 'Документ не найден'})
         
         # Отправляем файл
-        from flask import send_file
         return send_file(document_path)
         
     except Exception as e:
@@ -584,10 +859,6 @@ def request_user_documents():
         if user_id not in users:
             return jsonify({'status': 'error', 'message': 'Пользователь не найден'})
         
-        # Импортируем бот и отправляем запрос документов
-        from bot import bot
-        from telebot import types
-        
         user = users[user_id]
         user_full_name = user.get('full_name', user.get('first_name', f'user_{user_id}'))
         
@@ -607,7 +878,7 @@ def request_user_documents():
         # Убираем все кнопки меню для процесса верификации
         markup = types.ReplyKeyboardRemove()
         
-        bot.send_message(user_id, user_message, parse_mode='Markdown', reply_markup=markup)
+        telegram_bot.send_message(user_id, user_message, parse_mode='Markdown', reply_markup=markup)
         
         return jsonify({
             'status': 'success',
@@ -644,7 +915,7 @@ def manage_admins():
             'password': password,
             'role': 'admin',
             'chat_id': chat_id,
-            'created_at': datetime.now().isoformat(),
+            'created_at': g.now_iso,
             'created_by': current_user.id
         }
         
@@ -708,6 +979,10 @@ def reset_all_data():
 def upload_console_photo():
     """Загрузка фото консоли в локальную папку"""
     try:
+        # Проверяем размер до чтения потока
+        if request.content_length and request.content_length > CONSOLE_PHOTO_MAX_SIZE:
+            return jsonify({'status': 'error', 'message': 'Файл слишком большой (максимум 10 MB)'})
+        
         if 'photo' not in request.files:
             return jsonify({'status': 'error', 'message': 'Файл не выбран'})
         
@@ -721,29 +996,26 @@ def upload_console_photo():
             return jsonify({'status': 'error', 'message': 'ID консоли не указан'})
         
         # Проверяем тип файла
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
         file_extension = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
         
-        if file_extension not in allowed_extensions:
+        if file_extension not in CONSOLE_PHOTO_ALLOWED_EXTENSIONS:
             return jsonify({
                 'status': 'error',
                 'message': 'Неподдерживаемый формат файла. Разрешены: PNG, JPG, JPEG, GIF, WEBP'
             })
         
         # Создаем директорию если не существует
-        console_images_dir = os.path.join('static', 'img', 'console')
-        os.makedirs(console_images_dir, exist_ok=True)
+        os.makedirs(CONSOLE_IMAGES_DIR, exist_ok=True)
         
         # Удаляем старое фото если существует
-        for ext in allowed_extensions:
-            old_file = os.path.join(console_images_dir, f"{console_id}.{ext}")
-            if os.path.exists(old_file):
-                os.remove(old_file)
+        for old_file in find_console_photo_files(console_id):
+            os.remove(old_file)
         
         # Сохраняем новое фото с именем ID консоли
         filename = f"{console_id}.{file_extension}"
-        file_path = os.path.join(console_images_dir, filename)
-        file.save(file_path)
+        file_path = os.path.join(CONSOLE_IMAGES_DIR, filename)
+        with open(file_path, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_CHUNK_SIZE)
         
         return jsonify({
             'status': 'success',
@@ -769,16 +1041,11 @@ def delete_console_photo(console_id):
             return jsonify({'status': 'error', 'message': 'Консоль не найдена'})
         
         # Удаляем файл фото если существует
-        console_images_dir = os.path.join('static', 'img', 'console')
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        
         deleted = False
-        for ext in allowed_extensions:
-            file_path = os.path.join(console_images_dir, f"{console_id}.{ext}")
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                deleted = True
-                print(f"Удален файл фото: {file_path}")
+        for file_path in find_console_photo_files(console_id):
+            os.remove(file_path)
+            deleted = True
+            print(f"Удален файл фото: {file_path}")
         
         # Удаляем photo_path из данных консоли
         if 'photo_path' in consoles[console_id]:
@@ -951,16 +1218,18 @@ def start_bot():
             bot.reply_to(message, "📭 Консоли пока недоступны")
             return
         
-        response = "🎮 Доступные консоли:\n\n"
+        parts = ["🎮 Доступные консоли:\n\n"]
         for console_id, console in consoles.items():
             status_emoji = "✅" if console['status'] == 'available' else "❌"
             games_text = ", ".join(console['games'][:3]) + ("..." if len(console['games']) > 3 else "")
-            response += f"{status_emoji} {console['name']} ({console['model']})\n"
-            response += f"💰 Аренда: {console['rental_price']} лей/час\n"
-            response += f"🎯 Игры: {games_text}\n"
-            response += f"🆔 ID: {console_id}\n\n"
-        
-        bot.reply_to(message, response)
+            parts.append(
+                f"{status_emoji} {console['name']} ({console['model']})\n"
+                f"💰 Аренда: {console['rental_price']} лей/час\n"
+                f"🎯 Игры: {games_text}\n"
+                f"🆔 ID: {console_id}\n\n"
+            )
+        
+        bot.reply_to(message, "".join(parts))
     
     @bot.message_handler(func=lambda message: message.text == '📊 Мой кабинет')
     def user_profile(message):
@@ -977,25 +1246,27 @@ def start_bot():
             return
         
         user = users[user_id]
-        user_rentals = [r for r in rentals.values() if r['user_id'] == user_id]
-        active_rentals = [r for r in user_rentals if r['status'] == 'active']
-        
-        response = f"👤 Ваш профиль:\n\n"
-        response += f"🆔 ID: {user_id}\n"
-        response += f"👤 Имя: {user['first_name']}\n"
-        response += f"📅 Регистрация: {user['joined_at'][:10]}\n"
-        response += f"📊 Всего аренд: {len(user_rentals)}\n"
-        response += f"🔄 Активных аренд: {len(active_rentals)}\n"
+        user_rentals = [rentals[rid] for rid in find_record_ids(RENTALS_FILE, 'user_id', user_id) if rid in rentals]
+        active_rentals = sorted((r for r in user_rentals if r['status'] == 'active'), key=lambda r: r['start_time'])
+        
+        parts = [
+            f"👤 Ваш профиль:\n\n"
+            f"🆔 ID: {user_id}\n"
+            f"👤 Имя: {user['first_name']}\n"
+            f"📅 Регистрация: {user['joined_at'][:10]}\n"
+            f"📊 Всего аренд: {len(user_rentals)}\n"
+            f"🔄 Активных аренд: {len(active_rentals)}\n"
+        ]
         
         if active_rentals:
-            response += "\n🎮 Активные аренды:\n"
+            parts.append("\n🎮 Активные аренды:\n")
             for rental in active_rentals:
-                response += f"• Консоль ID: {rental['console_id']}\n"
-                response += f"  Начало: {rental['start_time'][:16]}\n"
+                parts.append(f"• Консоль ID: {rental['console_id']}\n  Начало: {rental['start_time'][:16]}\n")
         
-        bot.reply_to(message, response)
+        bot.reply_to(message, "".join(parts))
     
-    bot.polling(none_stop=True)
+    # Long polling с автоматическим переподключением; накопившиеся за время простоя обновления пропускаем
+    bot.infinity_polling(timeout=25, long_polling_timeout=25, skip_pending=True)
 
 # Новый API endpoint для мониторинга производительности
 @app.route('/api/performance', methods=['GET'])
@@ -1062,44 +1333,13 @@ def cleanup_large_files():
             'discounts.json', 'temp_reservations.json'
         ]
         
-        for filename in data_files:
-            file_path = os.path.join(DATA_DIR, filename)
-            if os.path.exists(file_path):
-                file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-                
-                if file_size_mb > max_size_mb:
-                    # Архивируем большие файлы
-                    data = load_json_file(file_path)
-                    
-                    # Создаем архивную папку
-                    archive_dir = os.path.join(DATA_DIR, 'archives')
-                    os.makedirs(archive_dir, exist_ok=True)
-                    
-                    # Создаем архив с timestamp
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    archive_filename = f"{filename.replace('.json', '')}_archive_{timestamp}.json"
-                    archive_path = os.path.join(archive_dir, archive_filename)
-                    
-                    # Сохраняем архив
-                    save_json_file(archive_path, data)
-                    
-                    # Очищаем оригинальный файл, оставляя базовую структуру
-                    if filename == 'users.json':
-                        save_json_file(file_path, {})
-                    elif filename == 'rentals.json':
-                        # Оставляем только активные аренды
-                        active_rentals = {k: v for k, v in data.items() if v.get('status') == 'active'}
-                        save_json_file(file_path, active_rentals)
-                    else:
-                        save_json_file(file_path, {})
-                    
-                    cleanup_results['archived_files'].append({
-                        'original': filename,
-                        'archive': archive_filename,
-                        'original_size_mb': file_size_mb
-                    })
-                    
-                    cleanup_results['space_freed_mb'] += file_size_mb * 0.8  # Приблизительная экономия
+        # Файлы независимы, поэтому архивируем их параллельно (ожидание диска перекрывается)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            archived = executor.map(lambda filename: _archive_data_file(filename, max_size_mb), data_files)
+            for archive_info in archived:
+                if archive_info:
+                    cleanup_results['archived_files'].append(archive_info)
+                    cleanup_results['space_freed_mb'] += archive_info['original_size_mb'] * 0.8  # Приблизительная экономия
         
         return jsonify({
             'status': 'success',
@@ -1113,6 +1353,46 @@ def cleanup_large_files():
             'message': f'Ошибка очистки файлов: {str(e)}'
         })
 
+def _archive_data_file(filename, max_size_mb):
+    """Архивирование одного файла данных, если он больше max_size_mb"""
+    file_path = os.path.join(DATA_DIR, filename)
+    if not os.path.exists(file_path):
+        return None
+    
+    file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
+    if file_size_mb <= max_size_mb:
+        return None
+    
+    # Создаем архивную папку
+    archive_dir = os.path.join(DATA_DIR, 'archives')
+    os.makedirs(archive_dir, exist_ok=True)
+    
+    # Создаем архив с timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    archive_filename = f"{filename.replace('.json', '')}_archive_{timestamp}.json.gz"
+    archive_path = os.path.join(archive_dir, archive_filename)
+    
+    # Сохраняем архив: сжимаем файл потоком, без разбора JSON
+    with open(file_path, 'rb') as src, gzip.open(archive_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+    
+    # Очищаем оригинальный файл, оставляя базовую структуру
+    if filename == 'users.json':
+        save_json_file(file_path, {})
+    elif filename == 'rentals.json':
+        # Оставляем только активные аренды (разбор нужен только здесь).
+        # Читаем напрямую: файл может превышать лимит размера менеджера БД
+        active_rentals = load_active_rentals(file_path)
+        save_json_file(file_path, active_rentals)
+    else:
+        save_json_file(file_path, {})
+    
+    return {
+        'original': filename,
+        'archive': archive_filename,
+        'original_size_mb': file_size_mb
+    }
+
 async def initialize_async_components():
     """Инициализация асинхронных компонентов"""
     try:
@@ -1122,11 +1402,11 @@ async def initialize_async_components():
         print(f"❌ Ошибка инициализации асинхронных компонентов: {e}")
 
 def run_async_init():
-    """Запуск асинхронной инициализации в отдельном потоке"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(initialize_async_components())
-    loop.close()
+    """Запуск асинхронной инициализации в общем фоновом цикле событий
+    
+    Воркеры обработчика работают бесконечно, поэтому результат не ожидается.
+    """
+    return asyncio.run_coroutine_threadsafe(initialize_async_components(), get_async_loop())
 
 # API для управления заблокированными датами
 @app.route('/api/blocked-dates', methods=['GET'])
@@ -1134,7 +1414,7 @@ def run_async_init():
 def get_blocked_dates():
     """Получить все заблокированные даты"""
     try:
-        blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+        blocked_dates = load_blocked_dates()
         return jsonify({
             'success': True,
             'data': blocked_dates
@@ -1153,11 +1433,10 @@ def add_system_blocked_date():
         if not date_str:
             return jsonify({'success': False, 'error': 'Дата не указана'})
         
-        blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+        blocked_dates = load_blocked_dates()
         
         if date_str not in blocked_dates['system_blocked_dates']:
-            blocked_dates['system_blocked_dates'].append(date_str)
-            blocked_dates['system_blocked_dates'].sort()
+            insort(blocked_dates['system_blocked_dates'], date_str)
             
             if save_json_file(BLOCKED_DATES_FILE, blocked_dates):
                 return jsonify({'success': True, 'message': f'Дата {date_str} заблокирована для всех консолей'})
@@ -1174,7 +1453,7 @@ def add_system_blocked_date():
 def remove_system_blocked_date(date_str):
     """Удалить системную заблокированную дату"""
     try:
-        blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+        blocked_dates = load_blocked_dates()
         
         if date_str in blocked_dates['system_blocked_dates']:
             blocked_dates['system_blocked_dates'].remove(date_str)
@@ -1201,21 +1480,21 @@ def add_console_blocked_date():
         if not console_id or not date_str:
             return jsonify({'success': False, 'error': 'Консоль или дата не указаны'})
         
-        blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+        blocked_dates = load_blocked_dates()
         
         if console_id not in blocked_dates['console_blocked_dates']:
             blocked_dates['console_blocked_dates'][console_id] = []
         
         if date_str not in blocked_dates['console_blocked_dates'][console_id]:
-            blocked_dates['console_blocked_dates'][console_id].append(date_str)
-            blocked_dates['console_blocked_dates'][console_id].sort()
-            
-            # Получаем название консоли для сообщения
-            consoles = load_json_file(CONSOLES_FILE)
-            console_name = consoles.get(console_id, {}).get('name', 'Неизвестная консоль')
+            insort(blocked_dates['console_blocked_dates'][console_id], date_str)
             
             if save_json_file(BLOCKED_DATES_FILE, blocked_dates):
-                return jsonify({'success': True, 'message': f'Дата {date_str} заблокирована для {console_name}'})
+                return jsonify({
+                    'success': True,
+                    'message': f'Дата {date_str} заблокирована для {get_console_name(console_id)}',
+                    'console_id': console_id,
+                    'date': date_str
+                })
             else:
                 return jsonify({'success': False, 'error': 'Ошибка сохранения'})
         else:
@@ -1229,7 +1508,7 @@ def add_console_blocked_date():
 def remove_console_blocked_date(console_id, date_str):
     """Удалить заблокированную дату для консоли"""
     try:
-        blocked_dates = load_json_file(BLOCKED_DATES_FILE)
+        blocked_dates = load_blocked_dates()
         
         if console_id in blocked_dates['console_blocked_dates'] and date_str in blocked_dates['console_blocked_dates'][console_id]:
             blocked_dates['console_blocked_dates'][console_id].remove(date_str)
@@ -1238,12 +1517,13 @@ def remove_console_blocked_date(console_id, date_str):
             if not blocked_dates['console_blocked_dates'][console_id]:
                 del blocked_dates['console_blocked_dates'][console_id]
             
-            # Получаем название консоли для сообщения
-            consoles = load_json_file(CONSOLES_FILE)
-            console_name = consoles.get(console_id, {}).get('name', 'Неизвестная консоль')
-            
             if save_json_file(BLOCKED_DATES_FILE, blocked_dates):
-                return jsonify({'success': True, 'message': f'Дата {date_str} разблокирована для {console_name}'})
+                return jsonify({
+                    'success': True,
+                    'message': f'Дата {date_str} разблокирована для {get_console_name(console_id)}',
+                    'console_id': console_id,
+                    'date': date_str
+                })
             else:
                 return jsonify({'success': False, 'error': 'Ошибка сохранения'})
         else:
@@ -1252,132 +1532,145 @@ def remove_console_blocked_date(console_id, date_str):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def _file_version(filename):
+    """Версия файла для ключей кеша: (mtime_ns, size) или None если файла нет"""
+    try:
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+@lru_cache(maxsize=512)
+def _compute_calendar_preview(console_id, year, month, today_str, calendar_version, rentals_version):
+    """Предпросмотр календаря консоли за месяц.
+    
+    Результат зависит только от аргументов: версии calendar.json и rentals.json входят в ключ кеша,
+    поэтому повторные запросы того же месяца не пересчитываются. Возвращаемый словарь изменять нельзя.
+    """
+    # Получаем данные календаря
+    calendar_data_file = load_json_file(CALENDAR_FILE)
+    
+    # Получаем настройки календаря
+    working_days = calendar_data_file.get('working_days', [1, 2, 3, 4, 5, 6, 7])
+    # Таблица рабочих дней, индексируемая номером дня недели (1-7)
+    working_day_mask = [weekday in working_days for weekday in range(8)]
+    # Множества вместо списков: проверка даты в цикле по дням месяца за O(1)
+    system_blocked = frozenset(calendar_data_file.get('system_blocked_dates', []))
+    console_blocked = frozenset(calendar_data_file.get('console_blocked_dates', {}).get(console_id, []))
+    reservations = calendar_data_file.get('reservations', {})
+    
+    # Получаем занятые даты (из активных аренд)
+    # Нужны только дни отображаемого месяца, поэтому диапазон аренды обрезается по его границам
+    month_start = date(year, month, 1)
+    month_end = date(year, month, calendar.monthrange(year, month)[1])
+    rentals = load_json_file(RENTALS_FILE)
+    occupied_rental_dates = set()
+    
+    for rental_id in find_record_ids(RENTALS_FILE, 'console_id', console_id):
+        rental = rentals.get(rental_id)
+        if rental and rental['status'] == 'active':
+            start_date = datetime.fromisoformat(rental['start_time']).date()
+            # Проверяем наличие estimated_end_time или end_time
+            end_time_str = rental.get('estimated_end_time') or rental.get('end_time')
+            if end_time_str:
+                end_date = datetime.fromisoformat(end_time_str).date()
+            else:
+                # Если нет времени окончания, считаем только день начала
+                end_date = start_date
+            
+            current_date = max(start_date, month_start)
+            end_date = min(end_date, month_end)
+            while current_date <= end_date:
+                occupied_rental_dates.add(current_date.isoformat())
+                current_date += timedelta(days=1)
+    
+    # Получаем занятые слоты из резерваций (только даты, на которые есть резервации)
+    occupied_reservation_dates = {
+        date_part for date_part, res_list in get_console_reservations(console_id).items() if res_list
+    }
+    
+    # Создаем календарь
+    cal = calendar.monthcalendar(year, month)
+    month_name = MONTH_NAMES[month]
+    
+    calendar_preview = {
+        'year': year,
+        'month': month,
+        'month_name': month_name,
+        'weeks': [],
+        'legend': CALENDAR_PREVIEW_LEGEND
+    }
+    
+    # Словарь праздников для быстрого поиска
+    holiday_dates = get_holidays_by_date()
+    
+    # Статусы особых дат: заполняем от высшего приоритета к низшему,
+    # setdefault не перезаписывает уже назначенный более важный статус
+    status_lookup = {}
+    for dates, date_status in (
+        (system_blocked, 'system_blocked'),
+        (console_blocked, 'console_blocked'),
+        (occupied_rental_dates, 'occupied'),
+        (occupied_reservation_dates, 'reserved'),
+    ):
+        for blocked_date in dates:
+            status_lookup.setdefault(blocked_date, date_status)
+    for holiday_date, holiday in holiday_dates.items():
+        # Рабочий праздник считается доступным днем
+        status_lookup.setdefault(holiday_date, 'available' if holiday.get('working', False) else 'holiday')
+    
+    for week in cal:
+        week_data = []
+        # Колонки monthcalendar идут с понедельника: 1 = понедельник, 7 = воскресенье
+        for weekday, day in enumerate(week, 1):
+            if day == 0:
+                week_data.append({'day': '', 'status': 'empty'})
+            else:
+                date_str = f"{year:04d}-{month:02d}-{day:02d}"
+                
+                # Определяем статус даты по приоритету
+                if date_str < today_str:
+                    status = 'past_date'
+                else:
+                    status = status_lookup.get(date_str) or (
+                        'available' if working_day_mask[weekday] else 'non_working_day'
+                    )
+                
+                day_info = {
+                    'day': day,
+                    'date': date_str,
+                    'status': status,
+                    'weekday': weekday
+                }
+                
+                # Добавляем дополнительную информацию
+                if date_str in holiday_dates:
+                    day_info['holiday_name'] = holiday_dates[date_str]['name']
+                
+                if date_str in occupied_reservation_dates:
+                    date_key = f"{date_str}_{console_id}"
+                    day_info['reservations_count'] = len(reservations.get(date_key, []))
+                
+                week_data.append(day_info)
+        
+        calendar_preview['weeks'].append(week_data)
+    
+    return calendar_preview
+
 @app.route('/api/calendar-preview/<console_id>/<year>/<month>')
 @login_required  
 def get_calendar_preview(console_id, year, month):
     """Получить предпросмотр календаря для консоли с учетом всех настроек"""
     try:
-        import calendar
-        
         year = int(year)
         month = int(month)
         
-        # Получаем данные календаря
-        calendar_data_file = load_json_file(CALENDAR_FILE)
-        
-        # Получаем настройки календаря
-        working_days = calendar_data_file.get('working_days', [1, 2, 3, 4, 5, 6, 7])
-        holidays = calendar_data_file.get('holidays', [])
-        system_blocked = calendar_data_file.get('system_blocked_dates', [])
-        console_blocked = calendar_data_file.get('console_blocked_dates', {}).get(console_id, [])
-        reservations = calendar_data_file.get('reservations', {})
-        
-        # Получаем занятые даты (из активных аренд)
-        rentals = load_json_file(RENTALS_FILE)
-        occupied_rental_dates = set()
-        
-        for rental in rentals.values():
-            if rental['console_id'] == console_id and rental['status'] == 'active':
-                start_date = datetime.fromisoformat(rental['start_time']).date()
-                # Проверяем наличие estimated_end_time или end_time
-                end_time_str = rental.get('estimated_end_time') or rental.get('end_time')
-                if end_time_str:
-                    end_date = datetime.fromisoformat(end_time_str).date()
-                else:
-                    # Если нет времени окончания, считаем только день начала
-                    end_date = start_date
-                
-                current_date = start_date
-                while current_date <= end_date:
-                    occupied_rental_dates.add(current_date.isoformat())
-                    current_date += timedelta(days=1)
-        
-        # Получаем занятые слоты из резерваций
-        occupied_reservation_dates = set()
-        for date_key, res_list in reservations.items():
-            if date_key.endswith(f"_{console_id}"):
-                date_part = date_key.split('_')[0]
-                if res_list:  # Если есть резервации на эту дату
-                    occupied_reservation_dates.add(date_part)
-        
-        # Создаем календарь
-        cal = calendar.monthcalendar(year, month)
-        month_name = calendar.month_name[month]
-        
-        today = date.today()
-        
-        calendar_preview = {
-            'year': year,
-            'month': month,
-            'month_name': month_name,
-            'weeks': [],
-            'legend': {
-                'available': 'Доступно',
-                'occupied': 'Занято (активная аренда)',
-                'reserved': 'Забронировано',
-                'system_blocked': 'Заблокировано (система)',
-                'console_blocked': 'Заблокировано (консоль)',
-                'non_working_day': 'Нерабочий день',
-                'holiday': 'Праздничный день',
-                'past_date': 'Прошедшая дата'
-            }
-        }
-        
-        # Создаем словарь праздников для быстрого поиска
-        holiday_dates = {}
-        for holiday in holidays:
-            holiday_dates[holiday['date']] = holiday
-        
-        for week in cal:
-            week_data = []
-            for day in week:
-                if day == 0:
-                    week_data.append({'day': '', 'status': 'empty'})
-                else:
-                    current_date = date(year, month, day)
-                    date_str = current_date.isoformat()
-                    weekday = current_date.weekday() + 1  # 1 = понедельник, 7 = воскресенье
-                    
-                    # Определяем статус даты по приоритету
-                    if current_date < today:
-                        status = 'past_date'
-                    elif date_str in system_blocked:
-                        status = 'system_blocked'
-                    elif date_str in console_blocked:
-                        status = 'console_blocked'
-                    elif date_str in occupied_rental_dates:
-                        status = 'occupied'
-                    elif date_str in occupied_reservation_dates:
-                        status = 'reserved'
-                    elif date_str in holiday_dates:
-                        # Проверяем, рабочий ли это праздник
-                        if holiday_dates[date_str].get('working', False):
-                            status = 'available'
-                        else:
-                            status = 'holiday'
-                    elif weekday not in working_days:
-                        status = 'non_working_day'
-                    else:
-                        status = 'available'
-                    
-                    day_info = {
-                        'day': day,
-                        'date': date_str,
-                        'status': status,
-                        'weekday': weekday
-                    }
-                    
-                    # Добавляем дополнительную информацию
-                    if date_str in holiday_dates:
-                        day_info['holiday_name'] = holiday_dates[date_str]['name']
-                    
-                    if date_str in occupied_reservation_dates:
-                        date_key = f"{date_str}_{console_id}"
-                        day_info['reservations_count'] = len(reservations.get(date_key, []))
-                    
-                    week_data.append(day_info)
-            
-            calendar_preview['weeks'].append(week_data)
+        # ISO-строки дат сравниваются лексикографически так же, как сами даты
+        today_str = date.today().isoformat()
+        calendar_preview = _compute_calendar_preview(
+            console_id, year, month, today_str,
+            _file_version(CALENDAR_FILE), _file_version(RENTALS_FILE)
+        )
         
         return jsonify({
             'success': True,
@@ -1459,16 +1752,14 @@ def manage_calendar_blocked_dates():
                     calendar_data['console_blocked_dates'][console_id] = []
                 
                 if date_str not in calendar_data['console_blocked_dates'][console_id]:
-                    calendar_data['console_blocked_dates'][console_id].append(date_str)
-                    calendar_data['console_blocked_dates'][console_id].sort()
-                    message = f'Дата {date_str} заблокирована для консоли'
+                    insort(calendar_data['console_blocked_dates'][console_id], date_str)
+                    message = f'Дата {date_str} заблокирована для {get_console_name(console_id)}'
                 else:
                     return jsonify({'success': False, 'error': 'Дата уже заблокирована'})
             else:
                 # Системная блокировка
                 if date_str not in calendar_data['system_blocked_dates']:
-                    calendar_data['system_blocked_dates'].append(date_str)
-                    calendar_data['system_blocked_dates'].sort()
+                    insort(calendar_data['system_blocked_dates'], date_str)
                     message = f'Дата {date_str} заблокирована системно'
                 else:
                     return jsonify({'success': False, 'error': 'Дата уже заблокирована'})
@@ -1496,7 +1787,7 @@ def manage_calendar_blocked_dates():
                     calendar_data['console_blocked_dates'][console_id].remove(date_str)
                     if not calendar_data['console_blocked_dates'][console_id]:
                         del calendar_data['console_blocked_dates'][console_id]
-                    message = f'Дата {date_str} разблокирована для консоли'
+                    message = f'Дата {date_str} разблокирована для {get_console_name(console_id)}'
                 else:
                     return jsonify({'success': False, 'error': 'Дата не найдена'})
             else:
@@ -1549,20 +1840,15 @@ def manage_calendar_reservations():
                 'notes': data.get('notes', '')
             }
             
-            # Проверка доступности
+            # Проверка конфликтов времени по индексу занятых слотов
             date_key = f"{reservation['date']}_{reservation['console_id']}"
-            if date_key not in calendar_data['reservations']:
-                calendar_data['reservations'][date_key] = []
-            
-            # Проверка конфликтов времени
-            for existing in calendar_data['reservations'][date_key]:
-                if existing['time_slot'] == reservation['time_slot']:
-                    return jsonify({
-                        'success': False, 
-                        'error': 'Время уже занято'
-                    })
+            if reservation['time_slot'] in get_taken_slots(date_key):
+                return jsonify({
+                    'success': False, 
+                    'error': 'Время уже занято'
+                })
             
-            calendar_data['reservations'][date_key].append(reservation)
+            calendar_data['reservations'].setdefault(date_key, []).append(reservation)
             save_json_file(CALENDAR_FILE, calendar_data)
             
             return jsonify({
@@ -1575,20 +1861,26 @@ def manage_calendar_reservations():
             data = request.get_json()
             reservation_id = data.get('reservation_id')
             
-            # Поиск и удаление резервации
-            for date_key, reservations in calendar_data['reservations'].items():
-                for i, reservation in enumerate(reservations):
-                    if reservation['id'] == reservation_id:
-                        del calendar_data['reservations'][date_key][i]
-                        if not calendar_data['reservations'][date_key]:
-                            del calendar_data['reservations'][date_key]
-                        
-                        save_json_file(CALENDAR_FILE, calendar_data)
-                        
-                        return jsonify({
-                            'success': True,
-                            'message': 'Резервация удалена'
-                        })
+            # Поиск резервации по обратному индексу
+            reservation_keys = get_db_manager().get_derived(
+                os.path.basename(CALENDAR_FILE), 'reservation_keys', _build_reservation_keys
+            )
+            date_key = reservation_keys.get(reservation_id)
+            reservations = calendar_data['reservations'].get(date_key)
+            if reservations:
+                remaining = [r for r in reservations if r['id'] != reservation_id]
+                if len(remaining) != len(reservations):
+                    if remaining:
+                        calendar_data['reservations'][date_key] = remaining
+                    else:
+                        del calendar_data['reservations'][date_key]
+                    
+                    save_json_file(CALENDAR_FILE, calendar_data)
+                    
+                    return jsonify({
+                        'success': True,
+                        'message': 'Резервация удалена'
+                    })
             
             return jsonify({'success': False, 'error': 'Резервация не найдена'})
         
@@ -1601,7 +1893,7 @@ def manage_calendar_reservations():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/api/calendar/availability/<console_id>/<date>')
+@app.route('/api/calendar/availability/<console_id>/<date_str>')
 @login_required
 def check_calendar_availability(console_id, date_str):
     """Проверить доступность консоли на дату"""
@@ -1610,7 +1902,7 @@ def check_calendar_availability(console_id, date_str):
         
         # Проверка системных блокировок
         if date_str in calendar_data.get('system_blocked_dates', []):
-            return jsonify({
+            return orjson_response({
                 'success': True,
                 'available': False,
                 'reason': 'system_blocked',
@@ -1620,7 +1912,7 @@ def check_calendar_availability(console_id, date_str):
         # Проверка блокировок консоли
         console_blocked = calendar_data.get('console_blocked_dates', {}).get(console_id, [])
         if date_str in console_blocked:
-            return jsonify({
+            return orjson_response({
                 'success': True,
                 'available': False,
                 'reason': 'console_blocked',
@@ -1634,9 +1926,10 @@ def check_calendar_availability(console_id, date_str):
         # Получаем доступные временные слоты
         all_slots = calendar_data.get('settings', {}).get('time_slots', [])
         occupied_slots = [r['time_slot'] for r in reservations if r['status'] == 'reserved']
-        available_slots = [slot for slot in all_slots if slot not in occupied_slots]
+        occupied_set = set(occupied_slots)
+        available_slots = [slot for slot in all_slots if slot not in occupied_set]
         
-        return jsonify({
+        return orjson_response({
             'success': True,
             'available': len(available_slots) > 0,
             'available_slots': available_slots,
@@ -1666,9 +1959,8 @@ def manage_calendar_holidays():
                 calendar_data['holidays'] = []
             
             # Проверка на дубликаты
-            for existing in calendar_data['holidays']:
-                if existing['date'] == holiday['date']:
-                    return jsonify({'success': False, 'error': 'Праздник уже существует'})
+            if holiday['date'] in get_holidays_by_date():
+                return jsonify({'success': False, 'error': 'Праздник уже существует'})
             
             calendar_data['holidays'].append(holiday)
             save_json_file(CALENDAR_FILE, calendar_data)
@@ -1683,6 +1975,13 @@ def manage_calendar_holidays():
             data = request.get_json()
             date_str = data.get('date')
             
+            # Файл перезаписывается, только если праздник действительно есть
+            if date_str not in get_holidays_by_date():
+                return jsonify({
+                    'success': True,
+                    'message': 'Праздник удален'
+                })
+            
             calendar_data['holidays'] = [
                 h for h in calendar_data.get('holidays', []) 
                 if h['date'] != date_str
@@ -1706,36 +2005,30 @@ def manage_calendar_holidays():
 
 # ===== СИСТЕМА РЕЙТИНГА КЛИЕНТОВ =====
 
-def calculate_discipline_score(transactions):
-    """Рассчитать дисциплину на основе последних транзакций"""
+def calculate_discipline_score(transactions, settings):
+    """Рассчитать дисциплину на основе последних транзакций (settings - настройки из ratings.json)"""
     if not transactions:
         return 50  # Базовый рейтинг для новых клиентов
     
-    ratings_data = load_json_file(RATINGS_FILE)
-    discipline_rules = ratings_data.get('settings', {}).get('discipline_rules', {})
-    window = ratings_data.get('settings', {}).get('transactions_window', 5)
+    discipline_rules = settings.get('discipline_rules', {})
+    window = settings.get('transactions_window', 5)
+    # Таблицы бонусов извлекаются один раз, в цикле остается один поиск на параметр
+    timing_bonuses = discipline_rules.get('return_timing', {})
+    condition_bonuses = discipline_rules.get('item_condition', {})
+    compliance_bonuses = discipline_rules.get('rule_compliance', {})
     
     # Берем последние N транзакций
     recent_transactions = transactions[-window:]
     scores = []
     
     for transaction in recent_transactions:
-        score = 100  # Базовый балл
-        
-        # Возврат вовремя
-        return_timing = transaction.get('return_timing', 'on_time')
-        timing_bonus = discipline_rules.get('return_timing', {}).get(return_timing, 0)
-        score += timing_bonus
-        
-        # Состояние имущества
-        item_condition = transaction.get('item_condition', 'perfect')
-        condition_bonus = discipline_rules.get('item_condition', {}).get(item_condition, 0)
-        score += condition_bonus
-        
-        # Соблюдение правил
-        rule_compliance = transaction.get('rule_compliance', 'no_violations')
-        compliance_bonus = discipline_rules.get('rule_compliance', {}).get(rule_compliance, 0)
-        score += compliance_bonus
+        # Базовый балл + возврат вовремя + состояние имущества + соблюдение правил
+        score = (
+            100
+            + timing_bonuses.get(transaction.get('return_timing', 'on_time'), 0)
+            + condition_bonuses.get(transaction.get('item_condition', 'perfect'), 0)
+            + compliance_bonuses.get(transaction.get('rule_compliance', 'no_violations'), 0)
+        )
         
         # Ограничиваем диапазон 0-100
         score = max(0, min(100, score))
@@ -1744,11 +2037,13 @@ def calculate_discipline_score(transactions):
     # Возвращаем среднее значение
     return round(sum(scores) / len(scores))
 
-def calculate_loyalty_score(user_id, user_data):
+@lru_cache(maxsize=4096)
+def _parse_joined_at(joined_at):
+    """Дата регистрации пользователя (строка не меняется, поэтому разбирается один раз)"""
+    return datetime.fromisoformat(joined_at)
+
+def calculate_loyalty_score(user_id, user_data, loyalty_rules):
     """Рассчитать лояльность клиента"""
-    ratings_data = load_json_file(RATINGS_FILE)
-    loyalty_rules = ratings_data.get('settings', {}).get('loyalty_rules', {})
-    
     score = 0
     
     # Повторные аренды
@@ -1763,7 +2058,7 @@ def calculate_loyalty_score(user_id, user_data):
     
     # Срок сотрудничества
     if 'joined_at' in user_data:
-        join_date = datetime.fromisoformat(user_data['joined_at'])
+        join_date = _parse_joined_at(user_data['joined_at'])
         tenure_days = (datetime.now() - join_date).days
         
         tenure_bonus = 0
@@ -1780,13 +2075,17 @@ def calculate_loyalty_score(user_id, user_data):
     # Ограничиваем диапазон 0-100
     return max(0, min(100, score))
 
-def calculate_final_rating(user_id):
-    """Рассчитать итоговый рейтинг клиента"""
-    ratings_data = load_json_file(RATINGS_FILE)
+# Ступени статусов от высшей к низшей: (статус, название, порог по умолчанию)
+STATUS_LADDER = (
+    ('premium', 'Premium', 80),
+    ('regular', 'Обычный', 50),
+)
+STATUS_LADDER_FALLBACK = ('risk', 'Риск')
+
+def calculate_final_rating(user_id, users, ratings_data):
+    """Рассчитать итоговый рейтинг клиента по уже загруженным users.json и ratings.json"""
     settings = ratings_data.get('settings', {})
     
-    # Загружаем данные пользователя
-    users = load_json_file(USERS_FILE)
     if user_id not in users:
         return None
     
@@ -1796,8 +2095,8 @@ def calculate_final_rating(user_id):
     user_transactions = ratings_data.get('transactions', {}).get(user_id, [])
     
     # Рассчитываем компоненты
-    discipline = calculate_discipline_score(user_transactions)
-    loyalty = calculate_loyalty_score(user_id, user_data)
+    discipline = calculate_discipline_score(user_transactions, settings)
+    loyalty = calculate_loyalty_score(user_id, user_data, settings.get('loyalty_rules', {}))
     
     # Итоговый рейтинг
     discipline_weight = settings.get('discipline_weight', 0.6)
@@ -1806,17 +2105,13 @@ def calculate_final_rating(user_id):
     final_score = round(discipline * discipline_weight + loyalty * loyalty_weight)
     final_score = max(0, min(100, final_score))
     
-    # Определяем статус
+    # Определяем статус: первая ступень, порог которой достигнут
     thresholds = settings.get('status_thresholds', {})
-    if final_score >= thresholds.get('premium', 80):
-        status = 'premium'
-        status_name = 'Premium'
-    elif final_score >= thresholds.get('regular', 50):
-        status = 'regular'
-        status_name = 'Обычный'
+    for status, status_name, default_threshold in STATUS_LADDER:
+        if final_score >= thresholds.get(status, default_threshold):
+            break
     else:
-        status = 'risk'
-        status_name = 'Риск'
+        status, status_name = STATUS_LADDER_FALLBACK
     
     return {
         'user_id': user_id,
@@ -1828,49 +2123,42 @@ def calculate_final_rating(user_id):
         'calculated_at': datetime.now().isoformat()
     }
 
+# Льготы по статусам (общие для всех запросов, изменять нельзя)
+STATUS_BENEFITS = {
+    'premium': {
+        'discount_percent': 10,
+        'deposit_multiplier': 0.8,
+        'priority_support': True,
+        'advance_booking_days': 45
+    },
+    'regular': {
+        'discount_percent': 0,
+        'deposit_multiplier': 1.0,
+        'priority_support': False,
+        'advance_booking_days': 30
+    },
+    'risk': {
+        'discount_percent': 0,
+        'deposit_multiplier': 1.5,
+        'priority_support': False,
+        'advance_booking_days': 7
+    }
+}
+
 def get_status_benefits(status):
     """Получить льготы по статусу"""
-    benefits = {
-        'premium': {
-            'discount_percent': 10,
-            'deposit_multiplier': 0.8,
-            'priority_support': True,
-            'advance_booking_days': 45
-        },
-        'regular': {
-            'discount_percent': 0,
-            'deposit_multiplier': 1.0,
-            'priority_support': False,
-            'advance_booking_days': 30
-        },
-        'risk': {
-            'discount_percent': 0,
-            'deposit_multiplier': 1.5,
-            'priority_support': False,
-            'advance_booking_days': 7
-        }
-    }
-    return benefits.get(status, benefits['regular'])
+    return STATUS_BENEFITS.get(status, STATUS_BENEFITS['regular'])
 
 @app.route('/api/ratings', methods=['GET'])
 @login_required
 def get_all_ratings():
     """Получить рейтинги всех пользователей"""
     try:
-        users = load_json_file(USERS_FILE)
-        ratings = []
-        
-        for user_id in users.keys():
-            rating = calculate_final_rating(user_id)
-            if rating:
-                rating['user_name'] = users[user_id].get('first_name', 'Неизвестный')
-                rating['username'] = users[user_id].get('username', '')
-                ratings.append(rating)
-        
-        # Сортируем по рейтингу (по убыванию)
-        ratings.sort(key=lambda x: x['final_score'], reverse=True)
+        ratings = _compute_all_ratings(
+            g.now_iso[:10], _file_version(RATINGS_FILE), _file_version(USERS_FILE)
+        )
         
-        return jsonify({
+        return orjson_response({
             'success': True,
             'ratings': ratings
         })
@@ -1878,19 +2166,43 @@ def get_all_ratings():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@lru_cache(maxsize=8)
+def _compute_all_ratings(today_str, ratings_version, users_version):
+    """Рейтинги всех пользователей, отсортированные по убыванию.
+    
+    Версии ratings.json (транзакции и настройки, в том числе записанные bot.py) и users.json
+    (данные для лояльности) входят в ключ кеша вместе с датой (стаж влияет на лояльность),
+    поэтому любое их изменение дает пересчет. Возвращаемый список изменять нельзя.
+    """
+    users = load_json_file(USERS_FILE)
+    ratings_data = load_json_file(RATINGS_FILE)
+    
+    ratings = []
+    for user_id, user in users.items():
+        rating = calculate_final_rating(user_id, users, ratings_data)
+        if rating:
+            rating['user_name'] = user.get('first_name', 'Неизвестный')
+            rating['username'] = user.get('username', '')
+            ratings.append(rating)
+    
+    # Сортируем по рейтингу (по убыванию)
+    ratings.sort(key=lambda x: x['final_score'], reverse=True)
+    return ratings
+
 @app.route('/api/ratings/<user_id>', methods=['GET'])
 @login_required
 def get_user_rating(user_id):
     """Получить рейтинг конкретного пользователя"""
     try:
-        rating = calculate_final_rating(user_id)
+        users = load_json_file(USERS_FILE)
+        ratings_data = load_json_file(RATINGS_FILE)
+        
+        rating = calculate_final_rating(user_id, users, ratings_data)
         if not rating:
             return jsonify({'success': False, 'error': 'Пользователь не найден'})
         
         # Получаем дополнительную информацию
-        users = load_json_file(USERS_FILE)
         user_data = users.get(user_id, {})
-        ratings_data = load_json_file(RATINGS_FILE)
         transactions = ratings_data.get('transactions', {}).get(user_id, [])
         
         rating['user_name'] = user_data.get('first_name', 'Неизвестный')
@@ -1931,24 +2243,27 @@ def add_rating_transaction():
             'created_by': current_user.id
         }
         
-        # Сохраняем транзакцию
-        ratings_data = load_json_file(RATINGS_FILE)
-        if user_id not in ratings_data['transactions']:
-            ratings_data['transactions'][user_id] = []
-        
-        ratings_data['transactions'][user_id].append(transaction)
-        save_json_file(RATINGS_FILE, ratings_data)
-        
-        # Пересчитываем рейтинг
-        new_rating = calculate_final_rating(user_id)
-        
-        # Сохраняем в историю рейтингов
-        if user_id not in ratings_data['rating_history']:
-            ratings_data['rating_history'][user_id] = []
-        
-        ratings_data['rating_history'][user_id].append(new_rating)
-        ratings_data['user_ratings'][user_id] = new_rating
-        save_json_file(RATINGS_FILE, ratings_data)
+        # Транзакция и пересчитанный рейтинг записываются в ratings.json один раз
+        # (при ошибке пересчета не сохраняется ни то, ни другое)
+        with batched_writes():
+            # Сохраняем транзакцию
+            ratings_data = load_json_file(RATINGS_FILE)
+            if user_id not in ratings_data['transactions']:
+                ratings_data['transactions'][user_id] = []
+            
+            ratings_data['transactions'][user_id].append(transaction)
+            save_json_file(RATINGS_FILE, ratings_data)
+            
+            # Пересчитываем рейтинг
+            new_rating = calculate_final_rating(user_id, load_json_file(USERS_FILE), ratings_data)
+            
+            # Сохраняем в историю рейтингов
+            if user_id not in ratings_data['rating_history']:
+                ratings_data['rating_history'][user_id] = []
+            
+            ratings_data['rating_history'][user_id].append(new_rating)
+            ratings_data['user_ratings'][user_id] = new_rating
+            save_json_file(RATINGS_FILE, ratings_data)
         
         return jsonify({
             'success': True,
@@ -2011,10 +2326,10 @@ def add_loyalty_bonus():
         save_json_file(USERS_FILE, users)
         
         # Пересчитываем рейтинг
-        new_rating = calculate_final_rating(user_id)
+        ratings_data = load_json_file(RATINGS_FILE)
+        new_rating = calculate_final_rating(user_id, users, ratings_data)
         
         # Сохраняем в историю
-        ratings_data = load_json_file(RATINGS_FILE)
         if user_id not in ratings_data['rating_history']:
             ratings_data['rating_history'][user_id] = []
         
@@ -2043,27 +2358,26 @@ def get_user_rentals(user_id):
         rentals = load_json_file(RENTALS_FILE)
         consoles = load_json_file(CONSOLES_FILE)
         
-        # Фильтруем аренды пользователя
-        user_rentals = []
-        for rental_id, rental in rentals.items():
-            if rental.get('user_id') == user_id:
-                # Добавляем информацию о консоли
-                console_info = consoles.get(rental.get('console_id'), {})
-                rental_info = {
-                    'id': rental_id,
-                    'console_id': rental.get('console_id'),
-                    'console_name': console_info.get('name', 'Неизвестная консоль'),
-                    'status': rental.get('status'),
-                    'start_time': rental.get('start_time'),
-                    'end_time': rental.get('end_time'),
-                    'total_cost': rental.get('total_cost', 0)
-                }
-                user_rentals.append(rental_info)
+        # Аренды пользователя по индексу user_id вместе с названием консоли
+        user_rentals = [
+            {
+                'id': rental_id,
+                'console_id': rental.get('console_id'),
+                'console_name': consoles.get(rental.get('console_id'), {}).get('name', 'Неизвестная консоль'),
+                'status': rental.get('status'),
+                'start_time': rental.get('start_time'),
+                'end_time': rental.get('end_time'),
+                'total_cost': rental.get('total_cost', 0)
+            }
+            for rental_id in find_record_ids(RENTALS_FILE, 'user_id', user_id)
+            for rental in (rentals.get(rental_id),)
+            if rental
+        ]
         
-        # Сортируем по дате начала (новые первыми)
-        user_rentals.sort(key=lambda x: x.get('start_time', ''), reverse=True)
+        # Сортируем по дате начала (новые первыми); аренды без даты - в конце
+        user_rentals.sort(key=lambda x: x['start_time'] or '', reverse=True)
         
-        return jsonify({
+        return orjson_response({
             'success': True,
             'rentals': user_rentals
         })
@@ -2079,49 +2393,59 @@ def get_rating_history():
         users = load_json_file(USERS_FILE)
         ratings_data = load_json_file(RATINGS_FILE)
         
-        history_data = []
+        all_transactions = ratings_data.get('transactions', {})
         
-        for user_id in users.keys():
-            user = users[user_id]
-            user_transactions = ratings_data.get('transactions', {}).get(user_id, [])
-            
-            for transaction in user_transactions:
-                if 'return_timing' in transaction:  # Это полная транзакция
-                    # Получаем описание рейтинга
-                    rating_desc = get_rating_description(
-                        transaction.get('return_timing'),
-                        transaction.get('item_condition'),
-                        transaction.get('rule_compliance')
-                    )
-                    
-                    history_data.append({
-                        'user_id': user_id,
-                        'user_name': user.get('first_name', 'Неизвестный'),
-                        'username': user.get('username', ''),
-                        'full_name': user.get('full_name', ''),
-                        'date': transaction.get('created_at', '')[:10],
-                        'return_timing': transaction.get('return_timing'),
-                        'item_condition': transaction.get('item_condition'),
-                        'rule_compliance': transaction.get('rule_compliance'),
-                        'notes': transaction.get('notes', ''),
-                        'description': rating_desc,
-                        'rental_id': transaction.get('rental_id', ''),
-                        'transaction_id': transaction.get('id', '')
-                    })
+        def transaction_date(item):
+            return item[1].get('created_at', '')[:10]
         
-        # Сортируем по дате (новые первыми)
-        history_data.sort(key=lambda x: x['date'], reverse=True)
-        
-        return jsonify({
-            'success': True,
-            'history': history_data
-        })
+        # Транзакции каждого пользователя упорядочиваются от новых дат к старым
+        # (для уже хронологического списка это линейный проход), после чего
+        # heapq.merge сливает их без общей сортировки всей истории
+        def user_history(user_id):
+            # Поля пользователя одинаковы для всех его транзакций и собираются один раз
+            user = users[user_id]
+            user_fields = {
+                'user_id': user_id,
+                'user_name': user.get('first_name', 'Неизвестный'),
+                'username': user.get('username', ''),
+                'full_name': user.get('full_name', '')
+            }
+            return sorted(
+                ((user_fields, t) for t in all_transactions.get(user_id, ()) if 'return_timing' in t),
+                key=transaction_date,
+                reverse=True
+            )
+        
+        merged = heapq.merge(*map(user_history, users), key=transaction_date, reverse=True)
+        
+        # Записи сериализуются по одной (без промежуточного списка словарей), но целиком до
+        # ответа: ошибка в любой транзакции дает JSON с ошибкой, а не оборванный ответ 200
+        items = []
+        for user_fields, transaction in merged:
+            t_get = transaction.get
+            return_timing = t_get('return_timing')
+            item_condition = t_get('item_condition')
+            rule_compliance = t_get('rule_compliance')
+            items.append(orjson.dumps({
+                **user_fields,
+                'date': t_get('created_at', '')[:10],
+                'return_timing': return_timing,
+                'item_condition': item_condition,
+                'rule_compliance': rule_compliance,
+                'notes': t_get('notes', ''),
+                'description': get_rating_description(return_timing, item_condition, rule_compliance),
+                'rental_id': t_get('rental_id', ''),
+                'transaction_id': t_get('id', '')
+            }, default=str))
+        
+        body = b'{"success":true,"history":[' + b','.join(items) + b']}'
+        return Response(body, mimetype='application/json')
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-def get_rating_description(return_timing, item_condition, rule_compliance):
-    """Получить описание рейтинга на основе параметров"""
+def _describe_rating(return_timing, item_condition, rule_compliance):
+    """Описание рейтинга на основе параметров (полный набор правил)"""
     if return_timing == 'on_time' and item_condition == 'perfect' and rule_compliance == 'no_violations':
         return '⭐ Отличная аренда'
     elif return_timing != 'on_time' and item_condition == 'perfect' and rule_compliance == 'no_violations':
@@ -2145,12 +2469,32 @@ def get_rating_description(return_timing, item_condition, rule_compliance):
     else:
         return '⚠️ Смешанные результаты'
 
+# Все 27 сочетаний известных значений рассчитываются один раз при импорте
+_RATING_DESCRIPTIONS = {
+    key: _describe_rating(*key)
+    for key in itertools.product(
+        ('on_time', 'late_1_24h', 'late_over_24h'),
+        ('perfect', 'minor_defects', 'major_defects'),
+        ('no_violations', 'minor_violation', 'major_violation')
+    )
+}
+
+def get_rating_description(return_timing, item_condition, rule_compliance):
+    """Получить описание рейтинга на основе параметров"""
+    description = _RATING_DESCRIPTIONS.get((return_timing, item_condition, rule_compliance))
+    if description is None:
+        # Нестандартные или отсутствующие значения - через полный набор правил
+        description = _describe_rating(return_timing, item_condition, rule_compliance)
+    return description
+
 if __name__ == '__main__':
     print("🚀 Запуск оптимизированного сервера...")
     
-    # Инициализация асинхронных компонентов в отдельном потоке
-    async_thread = threading.Thread(target=run_async_init, daemon=True)
-    async_thread.start()
+    # Все модули и настройки загружены: объекты запуска больше не обходятся сборщиком мусора
+    freeze_startup_objects()
+    
+    # Инициализация асинхронных компонентов в фоновом цикле событий
+    run_async_init()
     
     # Запуск бота в отдельном потоке
     threading.Thread(target=start_bot, daemon=True).start()
@@ -1,7 +1,6 @@
 import asyncio
 import aiohttp
-import aiofiles
-import json
+import orjson
 import os
 import logging
 from datetime import datetime
@@ -11,27 +10,63 @@ import threading
 from functools import wraps
 import time
 
+from config import TELEGRAM_HOST_POOL
+from bot import PASSPORT_DIR, get_user_safe_name
 from performance_optimizer import (
-    db_manager, file_handler, data_processor, memory_optimizer,
-    async_cached, memory_optimized
+    get_db_manager, get_file_handler, get_memory_optimizer,
+    memory_optimized, write_bytes_atomic
 )
 
 logger = logging.getLogger(__name__)
 
+# Размер блока чтения из сети при скачивании файлов
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Число параллельных потребителей каждой очереди
+MESSAGE_WORKERS = 32
+CALLBACK_WORKERS = 16
+FILE_WORKERS = 8
+
+# Общий лимит Telegram на исходящие сообщения бота в секунду
+SEND_RATE_LIMIT = 30
+
+# Пакетная запись новых пользователей: по числу накопленных или по паузе (сек)
+USERS_FLUSH_BATCH = 16
+USERS_FLUSH_DELAY = 2.0
+
+# Буфер чтения ответа: крупные блоки при скачивании не упираются в 64 KiB по умолчанию
+HTTP_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
 class AsyncBotHandler:
     """Асинхронный обработчик бота с высокой производительностью"""
     
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
         self.api_url = f"https://api.telegram.org/bot{bot_token}"
+        # Адреса методов API не меняются, собираются один раз
+        self.send_message_url = f"{self.api_url}/sendMessage"
+        self.get_file_url = f"{self.api_url}/getFile"
+        self.file_url_prefix = f"https://api.telegram.org/file/bot{bot_token}/"
         self.session = None
-        self.executor = ThreadPoolExecutor(max_workers=16)
+        # Пул только для дисковых операций (скачанные файлы, папки); обработка
+        # изображений идет в собственном пуле обработчика файлов и не занимает его
+        self.disk_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='disk')
         
         # Очереди для асинхронной обработки
         self.message_queue = asyncio.Queue(maxsize=1000)
         self.callback_queue = asyncio.Queue(maxsize=500)
         self.file_queue = asyncio.Queue(maxsize=100)
         
+        # Новые пользователи, еще не записанные в users.json (записываются пачкой)
+        self.pending_users = {}
+        self.users_flush_event = asyncio.Event()
+        
+        # Ограничение исходящих сообщений: не больше SEND_RATE_LIMIT в секунду
+        self.send_bucket = asyncio.Semaphore(SEND_RATE_LIMIT)
+        self.sends_in_window = 0
+        
         # Статистика производительности
         self.stats = {
             'messages_processed': 0,
@@ -39,6 +74,8 @@ class AsyncBotHandler:
             'start_time': time.time(),
             'errors': 0
         }
+        # (время, обработано сообщений) на момент предыдущего сбора статистики
+        self.last_stats_snapshot = (self.stats['start_time'], 0)
         
         logger.info("Асинхронный обработчик бота инициализирован")
     
@@ -46,25 +83,33 @@ class AsyncBotHandler:
         """Запуск асинхронного обработчика"""
         try:
             # Создание HTTP сессии с оптимизацией
+            # Почти весь трафик идет на один хост, поэтому ограничивается только
+            # число соединений с ним; DNS кешируется, соединения живут дольше
             connector = aiohttp.TCPConnector(
-                limit=100,
-                limit_per_host=30,
-                keepalive_timeout=30,
+                limit=0,
+                limit_per_host=TELEGRAM_HOST_POOL,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
                 enable_cleanup_closed=True
             )
             
             timeout = aiohttp.ClientTimeout(total=30, connect=10)
             self.session = aiohttp.ClientSession(
                 connector=connector,
-                timeout=timeout
+                timeout=timeout,
+                read_bufsize=HTTP_READ_BUFFER_SIZE,
+                json_serialize=lambda obj: orjson.dumps(obj).decode()
             )
             
-            # Запуск воркеров для обработки очередей
+            # Запуск воркеров: очереди разбирают несколько потребителей, чтобы
+            # ожидание ответа Telegram по одному сообщению не задерживало остальные
             tasks = [
-                asyncio.create_task(self._message_worker()),
-                asyncio.create_task(self._callback_worker()),
-                asyncio.create_task(self._file_worker()),
-                asyncio.create_task(self._stats_worker())
+                *(asyncio.create_task(self._message_worker()) for _ in range(MESSAGE_WORKERS)),
+                *(asyncio.create_task(self._callback_worker()) for _ in range(CALLBACK_WORKERS)),
+                *(asyncio.create_task(self._file_worker()) for _ in range(FILE_WORKERS)),
+                asyncio.create_task(self._stats_worker()),
+                asyncio.create_task(self._users_flush_worker()),
+                asyncio.create_task(self._send_refill_worker())
             ]
             
             logger.info("Асинхронный обработчик запущен")
@@ -76,9 +121,10 @@ class AsyncBotHandler:
     
     async def stop(self):
         """Остановка обработчика"""
+        await self._flush_pending_users()
         if self.session:
             await self.session.close()
-        self.executor.shutdown(wait=True)
+        self.disk_pool.shutdown(wait=True)
         logger.info("Асинхронный обработчик остановлен")
     
     async def _message_worker(self):
@@ -136,13 +182,61 @@ class AsyncBotHandler:
             try:
                 await asyncio.sleep(60)  # Каждую минуту
                 await self._collect_stats()
-                memory_optimizer.optimize_memory()
+                get_memory_optimizer().optimize_memory()
                 
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"Ошибка в stats_worker: {e}")
     
+    async def _users_flush_worker(self):
+        """Воркер для пакетной записи новых пользователей"""
+        while True:
+            try:
+                # Запись по накоплении пачки или после паузы без регистраций
+                try:
+                    await asyncio.wait_for(self.users_flush_event.wait(), timeout=USERS_FLUSH_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+                self.users_flush_event.clear()
+                await self._flush_pending_users()
+                
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Ошибка в users_flush_worker: {e}")
+                self.stats['errors'] += 1
+    
+    async def _send_refill_worker(self):
+        """Воркер, раз в секунду возвращающий израсходованные разрешения на отправку"""
+        while True:
+            try:
+                await asyncio.sleep(1)
+                used, self.sends_in_window = self.sends_in_window, 0
+                for _ in range(used):
+                    self.send_bucket.release()
+                
+            except asyncio.CancelledError:
+                break
+    
+    async def _flush_pending_users(self):
+        """Записать накопленных пользователей в users.json одной записью"""
+        if not self.pending_users:
+            return
+        
+        pending, self.pending_users = self.pending_users, {}
+        try:
+            # Файл перечитывается перед записью, чтобы не затереть изменения бота и веб-панели
+            users = await get_db_manager().load_data('users.json')
+            for user_id, user in pending.items():
+                users.setdefault(user_id, user)
+            await get_db_manager().save_data('users.json', users)
+        except Exception:
+            # Не теряем пользователей: вернем их в очередь на следующую запись
+            for user_id, user in pending.items():
+                self.pending_users.setdefault(user_id, user)
+            raise
+    
     async def add_message_to_queue(self, message_data: Dict) -> bool:
         """Добавление сообщения в очередь обработки"""
         try:
@@ -170,34 +264,43 @@ class AsyncBotHandler:
             logger.warning("Очередь файлов переполнена")
             return False
     
-    @async_cached(ttl=300)
     async def _process_message_async(self, message_data: Dict):
         """Асинхронная обработка сообщения"""
         try:
             message_type = message_data.get('type', 'text')
             user_id = str(message_data.get('user_id', ''))
             
-            # Загрузка данных пользователя асинхронно
-            users = await db_manager.load_data('users.json')
-            
-            # Проверка бана
-            if users.get(user_id, {}).get('is_banned', False):
+            # Проверка бана по множеству заблокированных (пересобирается при изменении users.json)
+            banned_ids = await get_db_manager().get_derived_async('users.json', 'banned_ids', self._collect_banned_ids)
+            if user_id in banned_ids:
                 await self._send_message_async(user_id, "❌ Вы заблокированы!")
                 return
             
             # Обработка в зависимости от типа
             if message_type == 'start':
-                await self._handle_start_async(message_data, users)
+                await self._handle_start_async(message_data, await self._load_users())
             elif message_type == 'consoles':
                 await self._handle_consoles_async(message_data)
             elif message_type == 'profile':
-                await self._handle_profile_async(message_data, users)
+                await self._handle_profile_async(message_data, await self._load_users())
             elif message_type == 'rental_request':
                 await self._handle_rental_request_async(message_data)
                 
         except Exception as e:
             logger.error(f"Ошибка обработки сообщения: {e}")
     
+    async def _load_users(self) -> Dict:
+        """Пользователи из users.json вместе с еще не записанными новыми"""
+        users = await get_db_manager().load_data('users.json')
+        for pending_id, pending_user in self.pending_users.items():
+            users.setdefault(pending_id, pending_user)
+        return users
+    
+    @staticmethod
+    def _collect_banned_ids(users: Dict) -> frozenset:
+        """ID заблокированных пользователей"""
+        return frozenset(user_id for user_id, user in users.items() if user.get('is_banned', False))
+    
     async def _handle_start_async(self, message_data: Dict, users: Dict):
         """Асинхронная обработка команды start"""
         user_id = str(message_data.get('user_id', ''))
@@ -205,7 +308,7 @@ class AsyncBotHandler:
         
         # Добавление нового пользователя если нужно
         if user_id not in users:
-            users[user_id] = {
+            users[user_id] = self.pending_users[user_id] = {
                 'id': user_id,
                 'username': user_info.get('username'),
                 'first_name': user_info.get('first_name'),
@@ -214,35 +317,37 @@ class AsyncBotHandler:
                 'joined_at': datetime.now().isoformat()
             }
             
-            # Сохранение асинхронно
-            await db_manager.save_data('users.json', users)
+            # Запись откладывается и объединяется с другими регистрациями
+            if len(self.pending_users) >= USERS_FLUSH_BATCH:
+                self.users_flush_event.set()
         
         # Отправка приветствия
         welcome_text = "🎮 Добро пожаловать в систему аренды PlayStation!\n\nВыберите действие:"
         await self._send_message_async(user_id, welcome_text)
     
-    @async_cached(ttl=60)
     async def _handle_consoles_async(self, message_data: Dict):
         """Асинхронная обработка запроса консолей"""
         user_id = str(message_data.get('user_id', ''))
         
-        # Загрузка консолей асинхронно
-        consoles = await db_manager.load_data('consoles.json')
+        # Текст списка общий для всех пользователей и пересобирается только при изменении consoles.json
+        response = await get_db_manager().get_derived_async('consoles.json', 'bot_consoles_text', self._render_consoles)
         
-        if not consoles:
+        if response is None:
             await self._send_message_async(user_id, "📭 Консоли пока недоступны")
             return
         
-        # Формирование ответа с использованием многопроцессорности
-        console_list = list(consoles.values())
-        formatted_consoles = data_processor.process_data_parallel(
-            console_list, 
-            self._format_console_info
-        )
-        
-        response = "🎮 Доступные консоли:\n\n" + "\n\n".join(formatted_consoles)
         await self._send_message_async(user_id, response)
     
+    @classmethod
+    def _render_consoles(cls, consoles: Dict) -> Optional[str]:
+        """Текст списка консолей (None, если консолей нет)"""
+        if not consoles:
+            return None
+        
+        # Форматирование - несколько строк на консоль, дешевле пула процессов
+        formatted_consoles = [cls._format_console_info(console) for console in consoles.values()]
+        return "🎮 Доступные консоли:\n\n" + "\n\n".join(formatted_consoles)
+    
     @staticmethod
     def _format_console_info(console: Dict) -> str:
         """Форматирование информации о консоли"""
@@ -264,12 +369,16 @@ class AsyncBotHandler:
             await self._send_message_async(user_id, "❌ Пользователь не найден")
             return
         
-        # Параллельная загрузка данных аренд
-        rentals = await db_manager.load_data('rentals.json')
+        db = get_db_manager()
+        rentals = await db.load_data('rentals.json')
         
+        # Аренды пользователя по индексу user_id вместо просмотра всех аренд
         user = users[user_id]
-        user_rentals = [r for r in rentals.values() if r.get('user_id') == user_id]
-        active_rentals = [r for r in user_rentals if r.get('status') == 'active']
+        rentals_by_user = await db.get_index_async('rentals.json', 'user_id')
+        user_rentals = [rentals[rental_id] for rental_id in rentals_by_user.get(user_id, ())
+                        if rental_id in rentals]
+        active_rentals = sorted((r for r in user_rentals if r.get('status') == 'active'),
+                                key=lambda r: r.get('start_time') or '')
         
         response = f"👤 Ваш профиль:\n\n"
         response += f"🆔 ID: {user_id}\n"
@@ -321,20 +430,19 @@ class AsyncBotHandler:
     async def _handle_passport_upload_async(self, user_id: str, file_info: Dict):
         """Асинхронная обработка загрузки паспорта"""
         try:
-            # Скачивание файла асинхронно
-            file_path = await self._download_file_async(file_info['file_id'])
+            # Файл скачивается в память и оптимизируется без временных файлов на диске
+            file_data = await self._download_file_async(file_info['file_id'])
             
-            if file_path:
-                # Проверка и оптимизация изображения
-                optimization_result = await file_handler.process_file_async(file_path, 'process_image')
+            if file_data:
+                optimized = await get_file_handler().process_image_bytes(file_data)
                 
-                if optimization_result:
-                    # Перемещение в папку пользователя
+                if optimized:
+                    # Готовый JPEG записывается в папку пользователя один раз
                     user_folder = await self._create_user_folder_async(user_id)
                     final_path = os.path.join(user_folder, f"{file_info['document_type']}.jpg")
-                    
-                    # Атомарное перемещение файла
-                    os.rename(optimization_result['optimized_path'], final_path)
+                    await asyncio.get_running_loop().run_in_executor(
+                        self.disk_pool, write_bytes_atomic, final_path, optimized
+                    )
                     
                     await self._send_message_async(user_id, "✅ Документ успешно загружен и обработан")
                 else:
@@ -345,36 +453,34 @@ class AsyncBotHandler:
         except Exception as e:
             logger.error(f"Ошибка обработки паспорта: {e}")
     
-    async def _download_file_async(self, file_id: str) -> Optional[str]:
-        """Асинхронное скачивание файла"""
+    async def _download_file_async(self, file_id: str) -> Optional[bytes]:
+        """Асинхронное скачивание файла в память"""
         try:
             # Получение информации о файле
-            file_info_url = f"{self.api_url}/getFile?file_id={file_id}"
-            
-            async with self.session.get(file_info_url) as response:
+            async with self.session.get(self.get_file_url, params={'file_id': file_id}) as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = await response.json(loads=orjson.loads)
                     file_path = data['result']['file_path']
                     
                     # Скачивание файла
-                    file_url = f"https://api.telegram.org/file/bot{self.bot_token}/{file_path}"
-                    
-                    async with self.session.get(file_url) as file_response:
+                    async with self.session.get(self.file_url_prefix + file_path) as file_response:
                         if file_response.status == 200:
                             # Проверка размера файла
+                            max_file_size = get_file_handler().max_file_size
                             content_length = file_response.headers.get('content-length')
-                            if content_length and int(content_length) > file_handler.max_file_size:
+                            if content_length and int(content_length) > max_file_size:
                                 logger.warning(f"Файл {file_id} превышает максимальный размер")
                                 return None
                             
-                            # Сохранение во временный файл
-                            temp_path = f"temp_{file_id}_{int(time.time())}.tmp"
+                            # Сеть читается блоками до 256 KiB; размер проверяется и без content-length
+                            buffer = bytearray()
+                            async for chunk in file_response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                buffer += chunk
+                                if len(buffer) > max_file_size:
+                                    logger.warning(f"Файл {file_id} превышает максимальный размер")
+                                    return None
                             
-                            async with aiofiles.open(temp_path, 'wb') as f:
-                                async for chunk in file_response.content.iter_chunked(8192):
-                                    await f.write(chunk)
-                            
-                            return temp_path
+                            return bytes(buffer)
             
             return None
             
@@ -383,23 +489,71 @@ class AsyncBotHandler:
             return None
     
     async def _create_user_folder_async(self, user_id: str) -> str:
-        """Асинхронное создание папки пользователя"""
-        users = await db_manager.load_data('users.json')
+        """Асинхронное создание папки пользователя
+        
+        Имя папки закрепляется за пользователем при первом назначении и дальше не меняется.
+        """
+        users = await self._load_users()
         user = users.get(user_id, {})
-        user_name = user.get('full_name', user.get('first_name', f'user_{user_id}'))
+        safe_name = user.get('safe_name')
         
-        # Безопасное имя папки
-        safe_name = "".join(c for c in user_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        user_folder = os.path.join('passport', safe_name)
+        if safe_name is None:
+            safe_name = get_user_safe_name(user, user_id)
+            if await self._folder_taken(safe_name, user_id):
+                safe_name = f"{safe_name}_{user_id}"
+            await self._store_safe_name(user_id, user, safe_name)
         
-        os.makedirs(user_folder, exist_ok=True)
+        user_folder = os.path.join(PASSPORT_DIR, safe_name)
+        
+        await asyncio.get_running_loop().run_in_executor(
+            self.disk_pool, lambda: os.makedirs(user_folder, exist_ok=True)
+        )
         return user_folder
     
+    async def _folder_taken(self, safe_name: str, user_id: str) -> bool:
+        """Занято ли имя папки другим пользователем"""
+        # Владельцы имен в users.json (пересобирается только при изменении файла)
+        owners = await get_db_manager().get_derived_async('users.json', 'folder_owners', self._collect_folder_owners)
+        owner_id = owners.get(safe_name)
+        if owner_id is not None:
+            return owner_id != user_id
+        
+        # Еще не записанные новые пользователи, уже получившие папку
+        if any(pending.get('safe_name') == safe_name
+               for pending_id, pending in self.pending_users.items() if pending_id != user_id):
+            return True
+        
+        # Папка без владельца (например, оставшаяся от удаленного пользователя)
+        user_folder = os.path.join(PASSPORT_DIR, safe_name)
+        return await asyncio.get_running_loop().run_in_executor(self.disk_pool, os.path.isdir, user_folder)
+    
+    @staticmethod
+    def _collect_folder_owners(users: Dict) -> Dict[str, str]:
+        """Имя папки -> ID пользователя, первым (в порядке регистрации) занявшего его"""
+        owners = {}
+        for user_id, user in users.items():
+            owners.setdefault(get_user_safe_name(user, user_id), user_id)
+        return owners
+    
+    async def _store_safe_name(self, user_id: str, user: Dict, safe_name: str):
+        """Закрепить имя папки за пользователем"""
+        stored_users = await get_db_manager().load_data('users.json')
+        if user_id in stored_users:
+            stored_users[user_id]['safe_name'] = safe_name
+            await get_db_manager().save_data('users.json', stored_users)
+        else:
+            # Новый пользователь: запись из очереди попадет в users.json при ближайшей записи
+            user['safe_name'] = safe_name
+    
     async def _send_message_async(self, chat_id: str, text: str, 
                                  reply_markup: Optional[Dict] = None) -> bool:
         """Асинхронная отправка сообщения"""
+        # Разрешение расходуется на отправку и возвращается воркером в следующую секунду,
+        # поэтому всплеск сообщений ждет в очереди вместо ответов 429 от Telegram
+        await self.send_bucket.acquire()
+        self.sends_in_window += 1
+        
         try:
-            url = f"{self.api_url}/sendMessage"
             data = {
                 'chat_id': chat_id,
                 'text': text,
@@ -407,9 +561,10 @@ class AsyncBotHandler:
             }
             
             if reply_markup:
-                data['reply_markup'] = json.dumps(reply_markup)
+                data['reply_markup'] = orjson.dumps(reply_markup).decode()
             
-            async with self.session.post(url, json=data) as response:
+            # Тело запроса сериализуется orjson, минуя стандартный json внутри aiohttp
+            async with self.session.post(self.send_message_url, data=orjson.dumps(data), headers=JSON_HEADERS) as response:
                 success = response.status == 200
                 if not success:
                     error_text = await response.text()
@@ -426,13 +581,20 @@ class AsyncBotHandler:
         try:
             current_time = time.time()
             uptime = current_time - self.stats['start_time']
+            messages_processed = self.stats['messages_processed']
+            
+            # Скорость за интервал с прошлого снимка, а не средняя за все время работы
+            last_time, last_messages = self.last_stats_snapshot
+            interval = current_time - last_time
+            messages_per_second = (messages_processed - last_messages) / interval if interval > 0 else 0
+            self.last_stats_snapshot = (current_time, messages_processed)
             
             stats_data = {
                 'uptime_seconds': uptime,
-                'messages_processed': self.stats['messages_processed'],
+                'messages_processed': messages_processed,
                 'files_processed': self.stats['files_processed'],
                 'errors': self.stats['errors'],
-                'messages_per_second': self.stats['messages_processed'] / uptime if uptime > 0 else 0,
+                'messages_per_second': messages_per_second,
                 'queue_sizes': {
                     'messages': self.message_queue.qsize(),
                     'callbacks': self.callback_queue.qsize(),
@@ -442,9 +604,9 @@ class AsyncBotHandler:
             }
             
             # Сохранение статистики
-            await db_manager.save_data('performance_stats.json', stats_data)
+            await get_db_manager().save_data('performance_stats.json', stats_data)
             
-            logger.info(f"Статистика: {self.stats['messages_processed']} сообщений, "
+            logger.info(f"Статистика: {messages_processed} сообщений, "
                        f"{self.stats['files_processed']} файлов, "
                        f"{stats_data['messages_per_second']:.2f} msg/sec")
                        
@@ -457,6 +619,9 @@ async_bot_handler = None
 async def initialize_async_bot_handler(bot_token: str):
     """Инициализация асинхронного обработчика"""
     global async_bot_handler
+    # Политика цикла (uvloop или Proactor) задается при импорте performance_optimizer
+    loop_class = type(asyncio.get_running_loop())
+    logger.info(f"Цикл событий обработчика: {loop_class.__module__}.{loop_class.__name__}")
     async_bot_handler = AsyncBotHandler(bot_token)
     await async_bot_handler.start()
 
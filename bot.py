@@ -658,9 +658,34 @@ def get_keyboard_for_user(user_id):
     else:
         return create_user_keyboard()
 
-def check_user_documents(user_full_name, user_id):
+class _SafeNameTable(dict):
+    """Таблица для str.translate: оставляет буквы, цифры, пробел, '-' и '_'.
+    
+    Заполняется лениво, поэтому каждый символ классифицируется только один раз.
+    """
+    def __missing__(self, code):
+        char = chr(code)
+        value = code if char.isalnum() or char in ' -_' else None
+        self[code] = value
+        return value
+
+SAFE_NAME_TABLE = _SafeNameTable()
+
+def make_safe_name(user_full_name):
+    """Безопасное имя папки пользователя для хранения документов"""
+    return user_full_name.translate(SAFE_NAME_TABLE).rstrip()
+
+def get_user_safe_name(user, user_id):
+    """Имя папки документов пользователя (сохраненное при регистрации или вычисленное)"""
+    safe_name = user.get('safe_name')
+    if safe_name is None:
+        safe_name = make_safe_name(user.get('full_name', user.get('first_name', f'user_{user_id}')))
+    return safe_name
+
+def check_user_documents(user_full_name, user_id, safe_name=None):
     """Проверить существующие документы пользователя"""
-    safe_name = "".join(c for c in user_full_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    if safe_name is None:
+        safe_name = make_safe_name(user_full_name)
     user_folder = os.path.join(PASSPORT_DIR, safe_name)
     
     documents = {
@@ -685,7 +710,7 @@ def check_user_documents(user_full_name, user_id):
     
     return documents
 
-def save_photo_document(file_id, user_full_name, document_type):
+def save_photo_document(file_id, user_full_name, document_type, safe_name=None):
     """Сохранить фотографию документа пользователя"""
     try:
         # Получаем информацию о файле
@@ -695,7 +720,8 @@ def save_photo_document(file_id, user_full_name, document_type):
         downloaded_file = bot.download_file(file_info.file_path)
         
         # Создаем папку пользователя
-        safe_name = "".join(c for c in user_full_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        if safe_name is None:
+            safe_name = make_safe_name(user_full_name)
         user_folder = os.path.join(PASSPORT_DIR, safe_name)
         
         # Создаем папку если её нет
@@ -914,7 +940,7 @@ def handle_photo_document(message):
         return
     
     # Сохраняем фотографию
-    result = save_photo_document(photo.file_id, user_full_name, document_type)
+    result = save_photo_document(photo.file_id, user_full_name, document_type, get_user_safe_name(user, user_id))
     
     if not result['success']:
         bot.reply_to(message, f"❌ Ошибка сохранения фото: {result['error']}")
@@ -1015,6 +1041,7 @@ def handle_full_name(message):
         
         # Завершаем регистрацию
         users[user_id]['full_name'] = full_name
+        users[user_id]['safe_name'] = make_safe_name(full_name)
         users[user_id]['registration_step'] = 'completed'
         save_json_file(USERS_FILE, users)
         
@@ -2721,7 +2748,7 @@ def handle_approve_request(call):
     user_full_name = user.get('full_name', user.get('first_name', f'user_{request["user_id"]}'))
     
     # Проверяем существующие документы
-    existing_documents = check_user_documents(user_full_name, request['user_id'])
+    existing_documents = check_user_documents(user_full_name, request['user_id'], get_user_safe_name(user, request['user_id']))
     all_documents_exist = all(existing_documents.values())
     
     if all_documents_exist:
@@ -3586,4 +3613,4 @@ def debug_all_callbacks(call):
 
 if __name__ == '__main__':
     print("🤖 Telegram бот запущен...")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    bot.infinity_polling(timeout=25, long_polling_timeout=25, skip_pending=True)
\ No newline at end of file
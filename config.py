@@ -1,23 +1,71 @@
+import logging
 import os
 import secrets
+import time
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+def _require_env(name):
+    """Обязательная переменная окружения (задается в .env)"""
+    value = os.getenv(name)
+    if not value:
+        raise RuntimeError(f"Не задана переменная окружения {name}. Укажите ее в файле .env (см. .env.example)")
+    return value
+
+def _read_secret_key(path):
+    """Ключ из файла или None, если файла нет или он пуст"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _load_secret_key(path=os.path.join('data', '.secret_key')):
+    """Секретный ключ Flask из файла; при первом запуске ключ генерируется и сохраняется"""
+    secret_key = _read_secret_key(path)
+    if secret_key:
+        return secret_key
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    secret_key = secrets.token_hex(32)
+    try:
+        # O_EXCL: из одновременно стартующих процессов файл создает только один,
+        # остальные читают его ключ; 0o600 - ключ доступен только владельцу
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Ключ пишет соседний процесс - ждем, пока он появится в файле
+        for _ in range(50):
+            existing_key = _read_secret_key(path)
+            if existing_key:
+                return existing_key
+            time.sleep(0.1)
+        raise RuntimeError(f"Файл секретного ключа {path} пуст. Удалите его или задайте SECRET_KEY в .env")
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(secret_key)
+        f.flush()
+        os.fsync(f.fileno())
+    logger.warning("SECRET_KEY не задан, сгенерирован и сохранен в %s. Установите свой в переменных окружения.", path)
+    return secret_key
+
 # Telegram Bot Configuration
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '8075876142:AAHDux8b_HScd73Vq_pHtwFCR4KDlBauPP4')
+TELEGRAM_BOT_TOKEN = _require_env('TELEGRAM_BOT_TOKEN')
+
+# Максимум одновременных соединений с api.telegram.org в асинхронном обработчике
+TELEGRAM_HOST_POOL = int(os.getenv('TELEGRAM_HOST_POOL', '128'))
 
 # Admin Configuration
-ADMIN_TELEGRAM_ID = os.getenv('ADMIN_TELEGRAM_ID', '762139684')
+ADMIN_TELEGRAM_ID = _require_env('ADMIN_TELEGRAM_ID')
 
 # Flask Configuration
-SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
+SECRET_KEY = os.getenv('SECRET_KEY')
 
-# Генерируем случайный ключ если используется дефолтный
-if SECRET_KEY == 'your-secret-key-here':
-    SECRET_KEY = secrets.token_hex(32)
-    print("⚠️ Используется автоматически сгенерированный SECRET_KEY. Установите свой в переменных окружения.")
+# Без своего ключа используется постоянный ключ из файла: сессии переживают перезапуск
+if not SECRET_KEY or SECRET_KEY == 'your-secret-key-here':
+    SECRET_KEY = _load_secret_key()
 
 # Database Configuration
 DATABASE_CONFIG = {
@@ -4,8 +4,9 @@
 """
 
 import os
-import json
+import orjson
 from datetime import datetime
+from performance_optimizer import write_bytes_atomic
 
 def init_admin():
     """Создает администратора по умолчанию если его нет"""
@@ -20,13 +21,13 @@ def init_admin():
     
     # Проверяем существование файла админов
     if os.path.exists(admins_file):
-        with open(admins_file, 'r', encoding='utf-8') as f:
+        with open(admins_file, 'rb') as f:
             try:
-                admins = json.load(f)
+                admins = orjson.loads(f.read())
                 if admins:  # Если есть админы, ничего не делаем
                     print("👤 Администраторы уже существуют")
                     return
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print("⚠️ Файл администраторов поврежден, создаем заново")
     
     # Создаем администратора по умолчанию
@@ -40,8 +41,7 @@ def init_admin():
         }
     }
     
-    with open(admins_file, 'w', encoding='utf-8') as f:
-        json.dump(default_admin, f, ensure_ascii=False, indent=2)
+    write_bytes_atomic(admins_file, orjson.dumps(default_admin, option=orjson.OPT_INDENT_2))
     
     print("👤 Создан администратор по умолчанию:")
     print("   Логин: admin")
@@ -60,11 +60,13 @@ def init_data_files():
         'admin_settings.json'
     ]
     
+    # Одно чтение каталога вместо проверки каждого файла по отдельности
+    os.makedirs(data_dir, exist_ok=True)
+    existing_files = {entry.name for entry in os.scandir(data_dir)}
+    
     for filename in files_to_init:
-        filepath = os.path.join(data_dir, filename)
-        if not os.path.exists(filepath):
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
+        if filename not in existing_files:
+            write_bytes_atomic(os.path.join(data_dir, filename), orjson.dumps({}))
             print(f"📄 Создан файл {filename}")
 
 def init_passport_dir():
@@ -1,5 +1,4 @@
 import asyncio
-import aiofiles
 import aiohttp
 import concurrent.futures
 import multiprocessing as mp
@@ -7,14 +6,22 @@ from multiprocessing import Pool, Manager, Lock
 import threading
 import time
 import os
-import json
+import sys
+import tempfile
+import mmap
+import orjson
 import psutil
 import gc
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+from collections import OrderedDict
+import functools
+import itertools
 from functools import lru_cache
+from stat import S_IMODE
 import logging
 from datetime import datetime
 from cachetools import TTLCache
+from cachetools.keys import hashkey
 # import numpy as np  # Отключено для совместимости
 from PIL import Image
 import io
@@ -23,15 +30,141 @@ import io
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def _install_event_loop_policy() -> None:
+    """Выбор самой быстрой реализации цикла событий для платформы
+    
+    Linux/macOS - uvloop (если установлен и не отключен через DISABLE_UVLOOP=1),
+    Windows - ProactorEventLoop на IOCP (в Python 3.7 по умолчанию еще Selector).
+    """
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+        return
+    
+    if os.getenv('DISABLE_UVLOOP') == '1':
+        return
+    
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+# Политика задается при импорте модуля, до создания любых циклов событий приложения
+_install_event_loop_policy()
+
+# Параметры обработки изображений
+MAX_IMAGE_SIZE = (1920, 1080)  # Full HD максимум
+RESAMPLE_FILTER = Image.Resampling.LANCZOS
+# Форматы оптимизированных копий: формат -> (расширение, параметры сохранения)
+IMAGE_SAVE_OPTIONS = {
+    'WEBP': ('webp', {'quality': 80, 'method': 4}),
+    'JPEG': ('jpg', {'quality': 85, 'optimize': True}),
+    'AVIF': ('avif', {'quality': 60}),  # требует pillow-avif-plugin
+}
+# Защита от "бомб" распаковки: фото с телефона намного меньше этого предела
+Image.MAX_IMAGE_PIXELS = 64 * 1024 * 1024
+
+# Признак промаха кеша (None - допустимый закешированный результат)
+_MISSING = object()
+
+def json_snapshot(data: Any) -> bytes:
+    """Компактный неизменяемый снимок JSON данных для кешей: каждый читатель разбирает свою копию"""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+# umask можно прочитать, только установив заново: читаем один раз при импорте, пока
+# других потоков, создающих файлы, еще нет
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _target_file_mode(file_path: str) -> int:
+    """Права для записываемого файла: как у существующего, иначе 0666 с учетом umask"""
+    try:
+        return S_IMODE(os.stat(file_path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+def write_bytes_atomic(file_path: str, data: bytes) -> None:
+    """Надежная атомарная запись файла целиком
+    
+    Временный файл с уникальным именем создается в той же папке (одновременные записи
+    не мешают друг другу), сбрасывается на диск и подменяет целевой через os.replace;
+    затем на диск сбрасывается сама папка, чтобы подмена пережила сбой питания.
+    """
+    directory = os.path.dirname(file_path) or '.'
+    mode = _target_file_mode(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp создает файл с правами 0600, а os.replace их сохраняет: возвращаем
+            # права прежнего файла (или обычные для нового), чтобы копии и веб-сервер могли его читать
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), mode)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        # Не оставляем недописанный временный файл
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    
+    # На Windows папку нельзя открыть для fsync; NTFS журналирует переименование сама
+    if os.name != 'nt':
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+class ShardedTTLCache:
+    """Потокобезопасный TTL кеш: ключи распределены по шардам, у каждого своя блокировка
+    
+    cachetools.TTLCache не потокобезопасен, а одна общая блокировка стала бы узким местом
+    для потоков пула и цикла событий.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float, shards: int = 8):
+        self._shards = [
+            (TTLCache(maxsize=max(1, maxsize // shards), ttl=ttl), threading.Lock())
+            for _ in range(shards)
+        ]
+    
+    def _shard(self, key: Any) -> Tuple[TTLCache, threading.Lock]:
+        return self._shards[hash(key) % len(self._shards)]
+    
+    def get(self, key: Any, default: Any = None) -> Any:
+        cache, lock = self._shard(key)
+        with lock:
+            return cache.get(key, default)
+    
+    def put(self, key: Any, value: Any) -> None:
+        cache, lock = self._shard(key)
+        with lock:
+            cache[key] = value
+    
+    def clear(self) -> None:
+        for cache, lock in self._shards:
+            with lock:
+                cache.clear()
+    
+    def __len__(self) -> int:
+        return sum(len(cache) for cache, _ in self._shards)
+
 class HighPerformanceFileHandler:
     """Высокопроизводительная обработка файлов с мультипроцессингом"""
     
-    def __init__(self, max_workers=None, max_file_size=50*1024*1024):  # 50MB лимит
+    # Начиная с этого размера JSON читается через mmap
+    MMAP_READ_THRESHOLD = 1024 * 1024
+    
+    def __init__(self, max_workers=None, max_file_size=50*1024*1024, image_format='WEBP'):  # 50MB лимит
         self.max_workers = max_workers or min(8, (os.cpu_count() or 1) * 2)  # Уменьшено для Windows
         self.max_file_size = max_file_size
+        # Формат оптимизированных копий изображений (см. IMAGE_SAVE_OPTIONS)
+        self.image_format = image_format
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
         self.process_pool = None  # Инициализируем позже, когда нужно
-        self.cache = TTLCache(maxsize=1000, ttl=300)  # 5 минут кеш
+        self.cache = ShardedTTLCache(maxsize=1000, ttl=300)  # 5 минут кеш
         
         # Создание менеджера для разделяемых данных - отложенная инициализация
         self.manager = None
@@ -40,19 +173,29 @@ class HighPerformanceFileHandler:
         
         logger.info(f"Инициализирован обработчик файлов с {self.max_workers} потоками")
     
-    async def process_file_async(self, file_path: str, operation: str = 'read') -> Optional[Any]:
-        """Асинхронная обработка файла"""
+    async def process_file_async(self, file_path: str, operation: str = 'read', use_cache: bool = True) -> Optional[Any]:
+        """Асинхронная обработка файла
+        
+        use_cache=False - без TTL кеша обработчика (у вызывающего свой кеш с проверкой версии файла).
+        """
         try:
-            # Проверка размера файла
-            file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            # Проверка размера файла: размер, время изменения и inode - одним вызовом stat
+            stat = self._stat(file_path)
+            if stat is None and operation == 'read':
+                # Отсутствующий файл читается как пустые данные: stat уже это показал,
+                # открывать файл и кешировать общий изменяемый {} незачем
+                return {}
+            
+            file_size, mtime_ns, inode = stat or (0, 0, 0)
             if file_size > self.max_file_size:
                 logger.warning(f"Файл {file_path} превышает лимит размера ({file_size} > {self.max_file_size})")
                 return None
             
-            # Кеширование для часто используемых файлов
-            cache_key = f"{file_path}:{operation}:{os.path.getmtime(file_path) if os.path.exists(file_path) else 0}"
-            if cache_key in self.cache:
-                return self.cache[cache_key]
+            # Кеширование для часто используемых файлов (inode выявляет подмену файла через os.replace)
+            cache_key = (file_path, operation, mtime_ns, file_size, inode)
+            cached = self._cache_get(cache_key) if use_cache else None
+            if cached is not None:
+                return cached
             
             if operation == 'read':
                 result = await self._read_file_async(file_path)
@@ -63,8 +206,8 @@ class HighPerformanceFileHandler:
             else:
                 result = None
             
-            if result is not None:
-                self.cache[cache_key] = result
+            if result is not None and use_cache:
+                self._cache_put(cache_key, result)
                 
             return result
             
@@ -72,49 +215,109 @@ class HighPerformanceFileHandler:
             logger.error(f"Ошибка обработки файла {file_path}: {e}")
             return None
     
-    async def _read_file_async(self, file_path: str) -> Optional[Dict]:
-        """Асинхронное чтение JSON файла"""
+    def _cache_get(self, cache_key: Tuple) -> Optional[Any]:
+        """Результат из кеша; прочитанные JSON данные каждый раз разбираются в новую копию"""
+        cached = self.cache.get(cache_key)
+        if cached is not None and cache_key[1] == 'read':
+            return orjson.loads(cached)
+        return cached
+    
+    def _cache_put(self, cache_key: Tuple, result: Any) -> None:
+        """Сохранить результат в кеш
+        
+        JSON данные хранятся снимком в байтах: вызывающий код изменяет полученный словарь
+        перед сохранением, и общий объект в кеше достался бы следующим читателям измененным.
+        """
+        self.cache.put(cache_key, json_snapshot(result) if cache_key[1] == 'read' else result)
+    
+    @staticmethod
+    def _stat(file_path: str) -> Optional[Tuple[int, int, int]]:
+        """Размер, время изменения (нс) и inode файла; None, если файла нет"""
         try:
-            async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                return json.loads(content) if content.strip() else {}
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns, st.st_ino
+    
+    def read_file_sync(self, file_path: str, use_cache: bool = True) -> Optional[Dict]:
+        """Синхронное чтение JSON файла с кешированием (без цикла событий)"""
+        try:
+            # Проверка размера файла: размер, время изменения и inode - одним вызовом stat
+            stat = self._stat(file_path)
+            if stat is None:
+                # Отсутствующий файл читается как пустые данные: stat уже это показал,
+                # открывать файл и кешировать общий изменяемый {} незачем
+                return {}
+            
+            file_size, mtime_ns, inode = stat
+            if file_size > self.max_file_size:
+                logger.warning(f"Файл {file_path} превышает лимит размера ({file_size} > {self.max_file_size})")
+                return None
+            
+            # Кеширование для часто используемых файлов (inode выявляет подмену файла через os.replace)
+            cache_key = (file_path, 'read', mtime_ns, file_size, inode)
+            cached = self._cache_get(cache_key) if use_cache else None
+            if cached is not None:
+                return cached
+            
+            result = self._read_file_sync(file_path)
+            if result is not None and use_cache:
+                self._cache_put(cache_key, result)
+            
+            return result
+            
+        except Exception as e:
+            logger.error(f"Ошибка обработки файла {file_path}: {e}")
+            return None
+    
+    def _read_file_sync(self, file_path: str) -> Optional[Dict]:
+        """Синхронное чтение JSON файла"""
+        try:
+            with open(file_path, 'rb') as f:
+                # Большие файлы разбираются прямо из отображения в память, без копии в bytes
+                if os.fstat(f.fileno()).st_size >= self.MMAP_READ_THRESHOLD:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        with memoryview(mapped) as view:
+                            return orjson.loads(view)
+                
+                content = f.read()
+                return orjson.loads(content) if content.strip() else {}
         except FileNotFoundError:
             return {}
         except Exception as e:
             logger.error(f"Ошибка чтения файла {file_path}: {e}")
             return {}
     
-    async def _write_file_async(self, file_path: str, data: Dict) -> bool:
-        """Асинхронная запись JSON файла с оптимизацией"""
+    async def _read_file_async(self, file_path: str) -> Optional[Dict]:
+        """Асинхронное чтение JSON файла: открытие, чтение и разбор - одна передача в пул потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._read_file_sync, file_path)
+    
+    @staticmethod
+    def serialize_json(data: Dict) -> bytes:
+        """Сериализация (UTF-8) в формат, в котором JSON файлы хранятся на диске"""
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    
+    async def _write_file_async(self, file_path: str, data: Optional[Dict], json_bytes: Optional[bytes] = None) -> bool:
+        """Асинхронная запись JSON файла с оптимизацией
+        
+        json_bytes - уже сериализованные данные, чтобы не сериализовать их повторно.
+        """
+        if json_bytes is None:
+            json_bytes = self.serialize_json(data)
+        
+        # Вся запись (открытие, запись, fsync, подмена) - одна передача в пул потоков
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._write_file_sync, file_path, json_bytes)
+    
+    @staticmethod
+    def _write_file_sync(file_path: str, json_bytes: bytes) -> bool:
+        """Синхронная атомарная запись файла"""
         try:
-            # Создание временного файла для атомарной записи
-            temp_path = f"{file_path}.tmp"
-            
-            async with aiofiles.open(temp_path, 'w', encoding='utf-8') as f:
-                json_str = json.dumps(data, ensure_ascii=False, indent=2, separators=(',', ':'))
-                await f.write(json_str)
-                # Принудительная запись на диск (Windows compatible)
-                try:
-                    await f.fsync()
-                except AttributeError:
-                    # Fallback для Windows - файл будет записан при закрытии
-                    pass
-            
-            # Атомарная замена файла
-            if os.name == 'nt':  # Windows
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                os.rename(temp_path, file_path)
-            else:  # Unix
-                os.rename(temp_path, file_path)
-                
+            write_bytes_atomic(file_path, json_bytes)
             return True
-            
         except Exception as e:
             logger.error(f"Ошибка записи файла {file_path}: {e}")
-            # Удаляем временный файл при ошибке
-            if os.path.exists(f"{file_path}.tmp"):
-                os.remove(f"{file_path}.tmp")
             return False
     
     async def _process_image_async(self, file_path: str) -> Optional[Dict]:
@@ -133,24 +336,19 @@ class HighPerformanceFileHandler:
             with Image.open(file_path) as img:
                 # Определение оптимального размера
                 original_size = img.size
-                max_size = (1920, 1080)  # Full HD максимум
                 
                 # Сжатие если изображение слишком большое
-                if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+                self._downscale(img)
                 
-                # Оптимизация качества
-                if img.format in ['JPEG', 'JPG']:
-                    quality = 85
-                elif img.format == 'PNG':
-                    img = img.convert('RGB')  # Конвертируем PNG в RGB для сжатия
-                    quality = 85
-                else:
-                    quality = 85
+                extension, save_options = IMAGE_SAVE_OPTIONS[self.image_format]
+                
+                # JPEG не хранит прозрачность и палитру; WebP и AVIF кодируют RGBA сами
+                if self.image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
                 
-                # Сохранение оптимизированной версии
-                optimized_path = file_path.replace('.', '_optimized.')
-                img.save(optimized_path, optimize=True, quality=quality)
+                # Сохранение оптимизированной версии рядом с исходной
+                optimized_path = f"{os.path.splitext(file_path)[0]}_optimized.{extension}"
+                img.save(optimized_path, format=self.image_format, **save_options)
                 
                 return {
                     'original_size': original_size,
@@ -163,46 +361,152 @@ class HighPerformanceFileHandler:
             logger.error(f"Ошибка синхронной обработки изображения: {e}")
             return {}
 
+    @staticmethod
+    def _downscale(img: Image.Image) -> None:
+        """Уменьшение изображения до MAX_IMAGE_SIZE за один проход
+        
+        draft до загрузки пикселей позволяет libjpeg сразу декодировать JPEG
+        в уменьшенном масштабе (DCT scaling), остальное делает один LANCZOS.
+        """
+        if img.size[0] <= MAX_IMAGE_SIZE[0] and img.size[1] <= MAX_IMAGE_SIZE[1]:
+            return
+        
+        if img.format == 'JPEG':
+            img.draft('RGB', MAX_IMAGE_SIZE)
+        img.thumbnail(MAX_IMAGE_SIZE, RESAMPLE_FILTER)
+    
+    async def process_image_bytes(self, data: bytes) -> Optional[bytes]:
+        """Оптимизация изображения в памяти: на входе содержимое файла, на выходе JPEG"""
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._process_image_bytes_sync, data)
+        except Exception as e:
+            logger.error(f"Ошибка обработки изображения в памяти: {e}")
+            return None
+    
+    def _process_image_bytes_sync(self, data: bytes) -> Optional[bytes]:
+        """Синхронная оптимизация изображения из байтов без временных файлов"""
+        if len(data) > self.max_file_size:
+            logger.warning(f"Изображение превышает лимит размера ({len(data)} > {self.max_file_size})")
+            return None
+        
+        with Image.open(io.BytesIO(data)) as img:
+            self._downscale(img)
+            
+            # JPEG не хранит прозрачность и палитру
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            
+            output = io.BytesIO()
+            img.save(output, format='JPEG', optimize=True, quality=85)
+            return output.getvalue()
+
+def freeze_startup_objects() -> None:
+    """Исключить объекты, созданные при запуске, из обхода сборщиком мусора
+    
+    Вызывается один раз после импорта модулей и загрузки настроек, до обработки запросов:
+    модули, приложение и константы живут до конца процесса, и обходить их при каждой
+    полной сборке незачем. Мусор, накопившийся к этому моменту, сначала собирается,
+    иначе он остался бы замороженным навсегда.
+    """
+    gc.collect()
+    gc.freeze()
+
+def _init_process_worker(initializer, initargs: Tuple) -> None:
+    """Подготовка процесса пула: выполняется один раз при его запуске, а не на каждый чанк"""
+    if initializer is not None:
+        initializer(*initargs)
+    freeze_startup_objects()
+
 class MultiCoreDataProcessor:
     """Многоядерный процессор данных"""
     
-    def __init__(self):
+    def __init__(self, initializer=None, initargs: Tuple = ()):
         self.cpu_count = os.cpu_count() or 1
         self.max_processes = min(8, self.cpu_count)
+        # Однократная подготовка каждого процесса пула (тяжелые константы, модели, regex)
+        self.initializer = initializer
+        self.initargs = initargs
         self.chunk_size = max(1, 1000 // self.max_processes)
+        # Пулы создаются один раз и переиспользуются между вызовами
+        self._tpool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_processes)
+        self._ppool = None
+        self._ppool_lock = threading.Lock()
         
         logger.info(f"Инициализирован процессор с {self.max_processes} процессами")
     
-    def process_data_parallel(self, data: List[Dict], operation_func, **kwargs) -> List[Any]:
-        """Параллельная обработка данных"""
+    def _get_process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Ленивое создание пула процессов (spawn - единственный способ запуска на Windows)"""
+        with self._ppool_lock:
+            if self._ppool is None:
+                self._ppool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_processes,
+                    mp_context=mp.get_context('spawn'),
+                    initializer=_init_process_worker,
+                    initargs=(self.initializer, self.initargs)
+                )
+            return self._ppool
+    
+    def process_data_parallel(self, data: List[Dict], operation_func, mode: Optional[str] = None, **kwargs) -> List[Any]:
+        """Параллельная обработка данных
+        
+        mode='process' - для CPU-нагрузки (обход GIL), mode='thread' - для ввода-вывода.
+        По умолчанию процессы выбираются для функций с атрибутом __cpu_bound__ = True.
+        В режиме процессов operation_func должна быть функцией уровня модуля, а вызывающий
+        скрипт - защищен `if __name__ == '__main__'`.
+        """
         if not data:
             return []
         
         try:
-            # Для Windows используем ThreadPoolExecutor вместо Pool
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_processes) as executor:
-                # Разделение данных на чанки
-                chunks = [data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size)]
-                
-                # Применяем функцию к каждому чанку параллельно
-                futures = [executor.submit(self._process_chunk, chunk, operation_func, kwargs) for chunk in chunks]
-                results = [future.result() for future in concurrent.futures.as_completed(futures)]
+            executor, chunks = self._plan(data, operation_func, mode)
+            worker = functools.partial(self._process_chunk, operation_func=operation_func, kwargs=kwargs)
+            results = executor.map(worker, chunks, chunksize=1)
             
-            # Объединяем результаты
-            flattened_results = []
-            for chunk_result in results:
-                if isinstance(chunk_result, list):
-                    flattened_results.extend(chunk_result)
-                else:
-                    flattened_results.append(chunk_result)
-            
-            return flattened_results
+            # map отдает результаты в порядке чанков, поэтому порядок элементов сохраняется
+            return list(itertools.chain.from_iterable(results))
             
         except Exception as e:
             logger.error(f"Ошибка параллельной обработки данных: {e}")
             # Fallback на однопоточную обработку
             return [operation_func(item, **kwargs) for item in data]
     
+    async def process_data_parallel_async(self, data: List[Dict], operation_func, mode: Optional[str] = None, **kwargs) -> List[Any]:
+        """Параллельная обработка данных из асинхронного кода (без блокировки цикла событий)
+        
+        Параметры те же, что у process_data_parallel.
+        """
+        if not data:
+            return []
+        
+        try:
+            executor, chunks = self._plan(data, operation_func, mode)
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(
+                loop.run_in_executor(executor, self._process_chunk, chunk, operation_func, kwargs)
+                for chunk in chunks
+            ))
+            return list(itertools.chain.from_iterable(results))
+            
+        except Exception as e:
+            logger.error(f"Ошибка параллельной обработки данных: {e}")
+            return [operation_func(item, **kwargs) for item in data]
+    
+    def _plan(self, data: List[Dict], operation_func, mode: Optional[str]) -> Tuple[concurrent.futures.Executor, List[List[Dict]]]:
+        """Выбор пула и разбиение данных на чанки"""
+        if mode is None:
+            mode = 'process' if getattr(operation_func, '__cpu_bound__', False) else 'thread'
+        
+        if mode == 'process':
+            # Мелкие чанки (по 4 на процесс) сглаживают неравномерную нагрузку
+            executor = self._get_process_pool()
+            chunk_size = max(1, len(data) // (self.max_processes * 4))
+        else:
+            executor = self._tpool
+            chunk_size = self.chunk_size
+        
+        return executor, [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    
     @staticmethod
     def _process_chunk(chunk: List[Dict], operation_func, kwargs: Dict) -> List[Any]:
         """Обработка чанка данных"""
@@ -219,6 +523,8 @@ class MemoryOptimizer:
         self.memory_threshold = 0.8  # 80% использования памяти
         self.gc_interval = 30  # секунд между сборкой мусора
         self.last_gc = time.time()
+        # Полная сборка (поколение 2) - только после стольких сборок поколения 1
+        self.full_gc_after = 10
     
     def check_memory_usage(self) -> Dict[str, float]:
         """Проверка использования памяти"""
@@ -235,26 +541,30 @@ class MemoryOptimizer:
         try:
             current_time = time.time()
             memory_info = self.check_memory_usage()
+            memory_pressure = memory_info['percent_used'] > self.memory_threshold * 100
             
             # Принудительная или по времени/памяти сборка мусора
             if (force or 
-                memory_info['percent_used'] > self.memory_threshold * 100 or
+                memory_pressure or
                 current_time - self.last_gc > self.gc_interval):
                 
-                logger.info(f"Запуск сборки мусора. Память: {memory_info['percent_used']:.1f}%")
+                # Полная сборка при нехватке памяти, по запросу или после накопления сборок
+                # поколения 1 (автоматическую полную сборку Python откладывает, пока новых
+                # долгоживущих объектов меньше 25%); иначе - поколения 0 и 1
+                counts = gc.get_count()
+                if force or memory_pressure or counts[2] >= self.full_gc_after:
+                    generation = 2
+                else:
+                    generation = 1
+                
+                logger.info(f"Запуск сборки мусора (поколение {generation}). Память: {memory_info['percent_used']:.1f}%")
                 
-                # Принудительная сборка мусора
-                collected = gc.collect()
+                collected = gc.collect(generation)
                 
                 # Обновляем время последней сборки
                 self.last_gc = current_time
                 
-                # Проверяем результат
-                new_memory_info = self.check_memory_usage()
-                freed_mb = (memory_info['used_gb'] - new_memory_info['used_gb']) * 1024
-                
-                logger.info(f"Сборка мусора завершена. Собрано {collected} объектов, "
-                           f"освобождено ~{freed_mb:.1f}MB")
+                logger.info(f"Сборка мусора завершена. Собрано {collected} объектов")
                 
                 return True
                 
@@ -270,62 +580,243 @@ class AsyncDatabaseManager:
     def __init__(self, data_dir: str = 'data'):
         self.data_dir = data_dir
         self.file_handler = HighPerformanceFileHandler()
-        self.cache = TTLCache(maxsize=500, ttl=60)  # 1 минута кеш для БД операций
-        self.lock = asyncio.Lock()
+        # LRU кеш: имя файла -> ((st_mtime_ns, st_size), снимок данных в orjson); запись сверяется с файлом при каждом чтении.
+        # Снимок неизменяем: каждое чтение разбирает собственную копию (stat + orjson.loads, без диска),
+        # поэтому изменения вызывающего кода кеш не портят
+        self.cache = OrderedDict()
+        self.cache_maxsize = 500
+        self.cache_lock = threading.RLock()
+        # Вторичные индексы: (имя файла, поле) -> (подпись файла, {значение поля: множество ключей})
+        self.indexes = {}
+        # Объединение одновременных сохранений: имя файла -> последние данные и ожидающие их записи
+        self._pending = {}
+        self._pending_waiters = {}
+        self._writers = {}
         
         # Создание директории если не существует
         os.makedirs(data_dir, exist_ok=True)
         
     async def load_data(self, filename: str) -> Dict:
-        """Загрузка данных с кешированием"""
+        """Загрузка данных с кешированием
+        
+        Попадание в кеш стоит одного stat и разбора снимка orjson (без чтения диска);
+        большие снимки разбираются в пуле потоков, чтобы не задерживать цикл событий.
+        """
         file_path = os.path.join(self.data_dir, filename)
         
         # Проверяем кеш
-        cache_key = f"load:{filename}"
-        if cache_key in self.cache:
-            return self.cache[cache_key].copy()
+        signature = self._file_signature(file_path)
+        snapshot = self._cache_get(filename, signature)
+        if snapshot is not None:
+            if len(snapshot) >= self.file_handler.MMAP_READ_THRESHOLD:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.file_handler.executor, orjson.loads, snapshot)
+            return orjson.loads(snapshot)
         
         # Загружаем из файла
-        data = await self.file_handler.process_file_async(file_path, 'read') or {}
+        # Чтение мимо TTL кеша обработчика: свой кеш уже проверен, а данные с диска
+        # разбираются в новый словарь, который не разделяется ни с одним кешем
+        data = await self.file_handler.process_file_async(file_path, 'read', use_cache=False) or {}
         
         # Кешируем результат
-        self.cache[cache_key] = data.copy()
+        self._cache_put(filename, signature, json_snapshot(data))
         
         return data
     
-    async def save_data(self, filename: str, data: Dict) -> bool:
-        """Сохранение данных с блокировкой"""
+    def load_data_sync(self, filename: str) -> Dict:
+        """Синхронная загрузка данных с кешированием
+        
+        Попадание в кеш стоит одного stat и разбора снимка orjson (без чтения диска).
+        """
         file_path = os.path.join(self.data_dir, filename)
         
-        async with self.lock:
-            try:
-                # Валидация размера данных
-                json_str = json.dumps(data, ensure_ascii=False)
-                data_size = len(json_str.encode('utf-8'))
-                
-                # Проверка на превышение размера файла
-                if data_size > self.file_handler.max_file_size:
-                    logger.warning(f"Данные для {filename} превышают максимальный размер")
-                    # Вместо удаления всех данных, создаем архив старых данных
-                    await self._archive_large_data(filename, data)
-                    return False
-                
-                # Сохранение
-                success = await self.file_handler._write_file_async(file_path, data)
-                
-                if success:
-                    # Обновляем кеш
-                    cache_key = f"load:{filename}"
-                    self.cache[cache_key] = data.copy()
+        # Проверяем кеш
+        signature = self._file_signature(file_path)
+        snapshot = self._cache_get(filename, signature)
+        if snapshot is not None:
+            return orjson.loads(snapshot)
+        
+        # Загружаем из файла
+        # Чтение мимо TTL кеша обработчика: свой кеш уже проверен, а данные с диска
+        # разбираются в новый словарь, который не разделяется ни с одним кешем
+        data = self.file_handler.read_file_sync(file_path, use_cache=False) or {}
+        
+        # Кешируем результат
+        self._cache_put(filename, signature, json_snapshot(data))
+        
+        return data
+    
+    def get_index(self, filename: str, field: str) -> Dict[Any, set]:
+        """Индекс записей файла по значению поля (например, user_id -> ключи аренд).
+        
+        Индекс перестраивается лениво при изменении файла; возвращаемые множества изменять нельзя.
+        """
+        return self.get_derived(filename, ('index', field), self._index_builder(field))
+    
+    async def get_index_async(self, filename: str, field: str) -> Dict[Any, set]:
+        """get_index для корутин: перестройка индекса идет в пуле потоков, а не в цикле событий"""
+        return await self.get_derived_async(filename, ('index', field), self._index_builder(field))
+    
+    @staticmethod
+    def _index_builder(field: str):
+        def build_index(data: Dict) -> Dict[Any, set]:
+            index = {}
+            for key, record in data.items():
+                if isinstance(record, dict) and record.get(field) is not None:
+                    index.setdefault(record[field], set()).add(key)
+            return index
+        return build_index
+    
+    def get_derived(self, filename: str, name: Any, builder) -> Any:
+        """Производная структура данных файла (индекс, группировка), построенная builder(data).
+        
+        Пересчитывается только при изменении файла; результат изменять нельзя.
+        Синхронная версия - для потоков Flask; из корутин используется get_derived_async.
+        """
+        file_path = os.path.join(self.data_dir, filename)
+        signature = self._file_signature(file_path)
+        derived_key = (filename, name)
+        
+        value = self._derived_get(derived_key, signature)
+        if value is not _MISSING:
+            return value
+        
+        value = builder(self.load_data_sync(filename))
+        
+        with self.cache_lock:
+            self.indexes[derived_key] = (signature, value)
+        return value
+    
+    async def get_derived_async(self, filename: str, name: Any, builder) -> Any:
+        """get_derived для корутин
+        
+        Актуальное значение отдается сразу; чтение файла и пересборка после его изменения
+        выполняются в пуле потоков обработчика файлов, чтобы не останавливать цикл событий.
+        """
+        signature = self._file_signature(os.path.join(self.data_dir, filename))
+        value = self._derived_get((filename, name), signature)
+        if value is not _MISSING:
+            return value
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.file_handler.executor, self.get_derived, filename, name, builder)
+    
+    def _derived_get(self, derived_key: Tuple[str, Any], signature: Optional[Tuple[int, int]]) -> Any:
+        """Производное значение, если оно построено по текущей версии файла (иначе _MISSING)"""
+        with self.cache_lock:
+            entry = self.indexes.get(derived_key)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+        return _MISSING
+    
+    @staticmethod
+    def _file_signature(file_path: str) -> Optional[Tuple[int, int]]:
+        """Подпись файла для проверки актуальности кеша"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+    
+    def _cache_get(self, filename: str, signature: Optional[Tuple[int, int]]) -> Optional[bytes]:
+        """Снимок данных из кеша, если файл не менялся с момента загрузки
+        
+        Вызывающий разбирает снимок сам (вне блокировки), получая собственный словарь:
+        это полный разбор на каждое попадание - плата за то, что изменения вызывающего
+        кода не портят кеш (общий объект пришлось бы глубоко копировать, что не дешевле).
+        """
+        with self.cache_lock:
+            entry = self.cache.get(filename)
+            if entry is None or entry[0] != signature:
+                return None
+            self.cache.move_to_end(filename)
+            return entry[1]
+    
+    def _cache_put(self, filename: str, signature: Optional[Tuple[int, int]], snapshot: bytes) -> None:
+        """Сохранить снимок данных в кеш с вытеснением давно не использованных файлов"""
+        with self.cache_lock:
+            self.cache[filename] = (signature, snapshot)
+            self.cache.move_to_end(filename)
+            while len(self.cache) > self.cache_maxsize:
+                self.cache.popitem(last=False)
+    
+    async def save_data(self, filename: str, data: Dict) -> bool:
+        """Сохранение данных с объединением одновременных записей одного файла
+        
+        Пока запись файла выполняется, новые вызовы только заменяют ожидающие данные;
+        после завершения записи последние данные сохраняются одной записью.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._pending[filename] = data
+        self._pending_waiters.setdefault(filename, []).append(waiter)
+        
+        if filename not in self._writers:
+            self._writers[filename] = asyncio.ensure_future(self._drain(filename))
+        
+        return await waiter
+    
+    async def _drain(self, filename: str) -> None:
+        """Запись ожидающих данных файла, пока они появляются"""
+        waiters = []
+        try:
+            while filename in self._pending:
+                data = self._pending.pop(filename)
+                waiters = self._pending_waiters.pop(filename)
                 
-                return success
+                success = await self._write_data(filename, data)
                 
-            except Exception as e:
-                logger.error(f"Ошибка сохранения {filename}: {e}")
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(success)
+        except BaseException as e:
+            # Запись прервана (отмена задачи и т.п.): ожидающие не должны висеть вечно -
+            # потоки Flask ждут результат run_async(...).result() без таймаута
+            self._pending.pop(filename, None)
+            for waiter in waiters + self._pending_waiters.pop(filename, []):
+                if waiter.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    waiter.cancel()
+                else:
+                    waiter.set_exception(e)
+            raise
+        finally:
+            del self._writers[filename]
+    
+    async def _write_data(self, filename: str, data: Dict) -> bool:
+        """Сериализация и запись данных в файл"""
+        file_path = os.path.join(self.data_dir, filename)
+        
+        try:
+            # Валидация размера данных: сериализуем один раз и эту же строку записываем
+            json_bytes = self.file_handler.serialize_json(data)
+            data_size = len(json_bytes)
+            
+            # Проверка на превышение размера файла
+            if data_size > self.file_handler.max_file_size:
+                logger.warning(f"Данные для {filename} превышают максимальный размер")
+                # Вместо удаления всех данных, создаем архив старых данных
+                await self._archive_large_data(filename, json_bytes)
                 return False
+            
+            # Сохранение
+            success = await self.file_handler._write_file_async(file_path, data, json_bytes)
+            
+            if success:
+                # Обновляем кеш с подписью только что записанного файла: записанные байты и есть снимок
+                self._cache_put(filename, self._file_signature(file_path), json_bytes)
+            
+            return success
+            
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {filename}: {e}")
+            return False
     
-    async def _archive_large_data(self, filename: str, data: Dict) -> None:
-        """Архивирование больших данных вместо удаления"""
+    async def _archive_large_data(self, filename: str, json_bytes: bytes) -> None:
+        """Архивирование больших данных вместо удаления
+        
+        json_bytes - уже сериализованные в save_data данные, архив пишется из них без повторной сериализации.
+        """
         try:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             archive_filename = f"{filename.replace('.json', '')}_archive_{timestamp}.json"
@@ -334,7 +825,7 @@ class AsyncDatabaseManager:
             os.makedirs(archive_path, exist_ok=True)
             
             archive_file = os.path.join(archive_path, archive_filename)
-            await self.file_handler._write_file_async(archive_file, data)
+            await self.file_handler._write_file_async(archive_file, None, json_bytes)
             
             logger.info(f"Данные {filename} заархивированы в {archive_filename}")
             
@@ -387,41 +878,84 @@ def memory_optimized(func):
 def async_cached(ttl: int = 300):
     """Декоратор для кеширования асинхронных функций"""
     def decorator(func):
-        cache = TTLCache(maxsize=100, ttl=ttl)
+        cache = ShardedTTLCache(maxsize=100, ttl=ttl)
         
         async def wrapper(*args, **kwargs):
-            # Создаем ключ кеша
-            cache_key = f"{func.__name__}:{hash(str(args) + str(sorted(kwargs.items())))}"
+            # Ключ кеша - кортеж аргументов, без построения строки из их repr; имя функции
+            # в ключ не входит, у каждой декорированной функции свой кеш. Сравнение ключей
+            # точное, так что коллизии хешей не дают ложных попаданий
+            cache_key = hashkey(*args, **kwargs)
+            try:
+                hash(cache_key)
+            except TypeError:
+                # Нехешируемые (изменяемые) аргументы не кешируем
+                return await func(*args, **kwargs)
             
-            if cache_key in cache:
-                return cache[cache_key]
+            cached = cache.get(cache_key, _MISSING)
+            if cached is not _MISSING:
+                return cached
             
             result = await func(*args, **kwargs)
-            cache[cache_key] = result
+            cache.put(cache_key, result)
             return result
             
         return wrapper
     return decorator
 
 # Утилиты для работы с производительностью
+class _CpuSampler(threading.Thread):
+    """Фоновый замер загрузки CPU, чтобы запрос статистики не ждал секунду в cpu_percent"""
+    
+    def __init__(self, interval: float = 2.0):
+        super().__init__(name='cpu-sampler', daemon=True)
+        self.interval = interval
+        # Первый вызов с interval=None только запоминает точку отсчета
+        psutil.cpu_percent(interval=None)
+        self.last_cpu = 0.0
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.last_cpu = psutil.cpu_percent(interval=None)
+
+_cpu_sampler = None
+_cpu_sampler_lock = threading.Lock()
+# Снимок памяти/диска/процессов переиспользуется в течение SYSTEM_STATS_TTL секунд
+SYSTEM_STATS_TTL = 0.5
+_system_stats = (0.0, None)
+
+def _get_cpu_sampler() -> _CpuSampler:
+    global _cpu_sampler
+    with _cpu_sampler_lock:
+        if _cpu_sampler is None:
+            _cpu_sampler = _CpuSampler()
+            _cpu_sampler.start()
+        return _cpu_sampler
+
 def get_system_performance() -> Dict[str, Any]:
     """Получение информации о производительности системы"""
+    global _system_stats
     try:
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
+        cpu_percent = _get_cpu_sampler().last_cpu
         
-        return {
-            'cpu_cores': psutil.cpu_count(),
-            'cpu_usage_percent': cpu_percent,
-            'memory_total_gb': memory.total / (1024**3),
-            'memory_used_gb': memory.used / (1024**3),
-            'memory_percent': memory.percent,
-            'disk_total_gb': disk.total / (1024**3),
-            'disk_used_gb': disk.used / (1024**3),
-            'disk_percent': (disk.used / disk.total) * 100,
-            'processes': len(psutil.pids())
-        }
+        taken_at, stats = _system_stats
+        now = time.monotonic()
+        if stats is None or now - taken_at > SYSTEM_STATS_TTL:
+            memory = psutil.virtual_memory()
+            disk = psutil.disk_usage('/')
+            stats = {
+                'cpu_cores': psutil.cpu_count(),
+                'memory_total_gb': memory.total / (1024**3),
+                'memory_used_gb': memory.used / (1024**3),
+                'memory_percent': memory.percent,
+                'disk_total_gb': disk.total / (1024**3),
+                'disk_used_gb': disk.used / (1024**3),
+                'disk_percent': (disk.used / disk.total) * 100,
+                'processes': len(psutil.pids())
+            }
+            _system_stats = (now, stats)
+        
+        return {**stats, 'cpu_usage_percent': cpu_percent}
     except Exception as e:
         logger.error(f"Ошибка получения информации о системе: {e}")
         return {}